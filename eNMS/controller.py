@@ -1,6 +1,6 @@
 from collections import Counter, defaultdict
 from contextlib import redirect_stdout
-from datetime import datetime
+from datetime import datetime, timedelta
 from difflib import unified_diff
 from dramatiq import actor
 from flask_login import current_user
@@ -8,7 +8,7 @@ from functools import wraps
 from git import Repo
 from io import BytesIO, StringIO
 from ipaddress import IPv4Network
-from json import dump, load
+from json import dump, load, loads
 from logging import info
 from operator import attrgetter, itemgetter
 from os import getenv, listdir, makedirs, scandir
@@ -18,13 +18,14 @@ from re import search, sub
 from requests import get as http_get
 from ruamel import yaml
 from shutil import rmtree
-from sqlalchemy import and_, cast, or_, String
+from sqlalchemy import and_, cast, func, or_, select, String
 from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import aliased
 from sqlalchemy.sql.expression import true
 from subprocess import Popen
 from tarfile import open as open_tar
 from threading import current_thread, Thread
+from time import time
 from traceback import format_exc
 from uuid import uuid4
 from xlrd import open_workbook
@@ -587,25 +588,34 @@ class Controller:
         return sorted(((run.runtime, run.runtime) for run in query.all()), reverse=True)
 
     def get_service_logs(self, service, runtime, line=0, device=None):
-        log_instance = db.fetch(
-            "service_log", allow_none=True, runtime=runtime, service_id=service
+        log, line = vs.models["service_log"], int(line)
+        query = db.session.query(log).filter(
+            log.runtime == runtime, log.service_id == service
         )
-        number_of_lines = 0
-        if log_instance:
-            lines = log_instance.content.splitlines()
+        total = query.with_entities(func.max(log.start_line + log.line_count)).scalar()
+        legacy_log = total is None and query.filter(log.line_count.is_(None)).first()
+        refresh = total is None and not legacy_log
+        if legacy_log:
+            lines = legacy_log.content.splitlines()
+            total = len(lines)
+        elif refresh:
+            lines = env.log_queue(runtime, service, start_line=line, mode="get") or []
+            total = line + len(lines)
         else:
-            lines = (
-                env.log_queue(runtime, service, start_line=int(line), mode="get") or []
-            )
-            number_of_lines = len(lines)
+            query = query.filter(log.start_line + log.line_count > line)
+            if device:
+                table = db.service_log_device_table
+                query = query.join(table, table.c.service_log_id == log.id).filter(
+                    table.c.device_id == int(device)
+                )
+            lines = []
+            for chunk in query.order_by(log.sequence).all():
+                offset = max(line - chunk.start_line, 0)
+                lines.extend(map(loads, chunk.content.splitlines()[offset:]))
         if device:
             device_name = db.fetch("device", id=device).name
             lines = [line for line in lines if f"DEVICE {device_name}" in line]
-        return {
-            "logs": "\n".join(lines),
-            "refresh": not log_instance,
-            "line": int(line) + number_of_lines,
-        }
+        return {"logs": "\n".join(lines), "refresh": refresh, "line": total}
 
     def get_service_state(self, path, **kwargs):
         state, run, path_id = None, None, path.split(">")
@@ -625,6 +635,7 @@ class Controller:
                 run = sorted(runs, key=attrgetter("runtime"), reverse=True)[0]
             else:
                 run = db.fetch("run", allow_none=True, runtime=runtime)
+            output["version"] = run.get_state_version() if run else None
             state = run.get_state() if run else None
         if kwargs.get("device") and run:
             output["device_state"] = {
@@ -653,6 +664,51 @@ class Controller:
             **output,
         }
 
+    def get_service_state_delta(self, path, **kwargs):
+        path_ids = path.split(">")
+        service = db.fetch("service", id=path_ids[-1])
+        run = (
+            db.query("run")
+            .filter(vs.models["run"].runtime == kwargs["runtime"])
+            .filter(vs.models["run"].service_id.in_(path_ids))
+            .first()
+        )
+        if not run:
+            return {"delta": False}
+        version, state = run.get_state_delta(int(kwargs.get("version") or 0))
+        run_properties = vs.automation["workflow"]["state_properties"]["run"]
+        return {
+            "delta": version is not None,
+            "last_modified": service.last_modified,
+            "run": run.get_properties(include=run_properties),
+            "state": state,
+            "version": version,
+        }
+
+    def get_target_devices(self, username):
+        user = db.fetch("user", name=username, rbac=None)
+        if user.is_admin:
+            return None
+        keys = [f"group/{group.id}" for group in user.groups] + [f"user/{user.id}"]
+        versions, target_devices = env.get_rbac_versions(keys), set()
+        cache_ttl = vs.settings["security"]["rbac_target_cache_ttl"]
+        for key in keys:
+            version, device_ids, expiry = vs.rbac_targets.get(key, (None, None, 0))
+            expired = not env.redis_queue and expiry <= time()
+            if version != versions[key] or expired:
+                model, instance_id = key.split("/")
+                table, column = {
+                    "group": (db.device_rbac_target_table, "group_id"),
+                    "user": (db.device_owner_table, "user_id"),
+                }[model]
+                query = db.session.query(table.c.device_id).filter(
+                    table.c[column] == int(instance_id)
+                )
+                device_ids = frozenset(device_id for device_id, in query)
+                vs.rbac_targets[key] = (versions[key], device_ids, time() + cache_ttl)
+            target_devices |= device_ids
+        return target_devices
+
     def get_session_log(self, session_id):
         return db.fetch("session", id=session_id).content
 
@@ -932,7 +988,7 @@ class Controller:
 
     def migration_import(self, folder="migrations", **kwargs):
         env.log("info", "Starting Migration Import")
-        env.log_events = False
+        env.log_events = env.pool_events = False
         status, models = "Import successful", kwargs["import_export_types"]
         empty_database = kwargs.get("empty_database_before_import", False)
         service_import = kwargs.get("service_import", False)
@@ -1058,11 +1114,10 @@ class Controller:
         if not kwargs.get("skip_pool_update"):
             before_time = datetime.now()
             env.log("info", "Starting pool update")
-            for pool in store["pool"].values():
-                pool.compute_pool()
+            vs.models["pool"].compute_pools(store["pool"].values())
             env.log("info", f"Pool update done ({datetime.now() - before_time}s)")
         db.session.commit()
-        env.log_events = True
+        env.log_events = env.pool_events = True
         env.log("info", f"{status} (execution time: {datetime.now() - start_time}s)")
         return status
 
@@ -1146,14 +1201,93 @@ class Controller:
         date_time_string = date_time_object.strftime("%Y-%m-%d %H:%M:%S.%f")
         for model in kwargs["deletion_types"]:
             if model == "run":
-                field_name = "runtime"
+                self.purge_runs(before=date_time_string)
             elif model == "changelog":
-                field_name = "time"
-            session_query = db.session.query(vs.models[model]).filter(
-                getattr(vs.models[model], field_name) < date_time_string
-            )
-            session_query.delete(synchronize_session=False)
+                self.purge_changelog(date_time_string)
+
+    def apply_retention_policies(self):
+        now, run, service = datetime.now(), vs.models["run"], vs.models["service"]
+        policies, deleted = vs.settings["retention"], {"run": 0, "changelog": 0}
+        for model, property in (("run", "runtime"), ("changelog", "time")):
+            days, count = policies[model]["days"], policies[model]["count"]
+            cutoffs = [str(now - timedelta(days=days))] if days else []
+            if count:
+                column = getattr(vs.models[model], property)
+                cutoffs.append(
+                    db.session.query(column)
+                    .order_by(column.desc())
+                    .offset(count - 1)
+                    .limit(1)
+                    .scalar()
+                )
+            cutoffs = [cutoff for cutoff in cutoffs if cutoff]
+            if not cutoffs:
+                continue
+            if model == "run":
+                deleted["run"] += self.purge_runs(before=max(cutoffs))
+            else:
+                deleted["changelog"] += self.purge_changelog(max(cutoffs))
+        services = db.session.query(
+            service.id, service.result_retention_days, service.result_retention_runs
+        ).filter(
+            or_(service.result_retention_days > 0, service.result_retention_runs > 0)
+        )
+        for service_id, days, count in services.all():
+            query = db.session.query(run.runtime).filter(run.service_id == service_id)
+            runtimes = set()
+            if days:
+                cutoff = str(now - timedelta(days=days))
+                expired_runs = query.filter(run.runtime < cutoff).all()
+                runtimes.update(runtime for runtime, in expired_runs)
+            if count:
+                older_runs = query.order_by(run.runtime.desc()).offset(count).all()
+                runtimes.update(runtime for runtime, in older_runs)
+            deleted["run"] += self.purge_runs(runtimes=list(runtimes))
+        env.log("info", f"Retention policies applied ({deleted})")
+        return deleted
+
+    def purge_changelog(self, before):
+        table = vs.models["changelog"].__table__
+        count = db.session.execute(table.delete().where(table.c.time < before))
+        db.session.commit()
+        return count.rowcount
+
+    def purge_runs(self, before=None, runtimes=None):
+        if before:
+            count = self.delete_runs(lambda runtime: runtime < before)
+        else:
+            count, chunk_size = 0, db.transactions["chunk_size"]
+            for index in range(0, len(runtimes or []), chunk_size):
+                chunk = runtimes[index : index + chunk_size]
+                count += self.delete_runs(lambda runtime: runtime.in_(chunk))
+        if count:
+            result = vs.models["result"].__table__
+            blob = vs.models["result_blob"].__table__
+            blob_ids = select(result.c.blob_id).where(result.c.blob_id.isnot(None))
+            db.session.execute(blob.delete().where(blob.c.id.notin_(blob_ids)))
             db.session.commit()
+        return count
+
+    def delete_runs(self, constraint):
+        run = vs.models["run"].__table__
+        run_ids = select(run.c.id).where(constraint(run.c.runtime))
+        for association in ("run_device", "run_pool", "run_service"):
+            table = getattr(db, f"{association}_table")
+            db.session.execute(table.delete().where(table.c.run_id.in_(run_ids)))
+        service_log = vs.models["service_log"].__table__
+        log_ids = select(service_log.c.id).where(constraint(service_log.c.runtime))
+        table = db.service_log_device_table
+        db.session.execute(table.delete().where(table.c.service_log_id.in_(log_ids)))
+        for model, property in (
+            ("result", "parent_runtime"),
+            ("service_log", "runtime"),
+            ("service_report", "runtime"),
+        ):
+            table = vs.models[model].__table__
+            db.session.execute(table.delete().where(constraint(table.c[property])))
+        count = db.session.execute(run.delete().where(constraint(run.c.runtime)))
+        db.session.commit()
+        return count.rowcount
 
     @staticmethod
     @actor(max_retries=0, time_limit=float("inf"))
@@ -1405,8 +1539,8 @@ class Controller:
                     info(f"{str(values)} could not be imported ({str(exc)})")
                     status = "Partial import (see logs)."
             db.session.commit()
-        for pool in db.fetch_all("pool", rbac="edit"):
-            pool.compute_pool()
+        if not vs.settings["pools"]["incremental_update"]:
+            vs.models["pool"].compute_pools(db.fetch_all("pool", rbac="edit"))
         env.log("info", status)
         return status
 
@@ -1442,8 +1576,7 @@ class Controller:
             return {"alert": str(exc)}
 
     def update_all_pools(self):
-        for pool in db.fetch_all("pool", rbac="edit"):
-            pool.compute_pool()
+        return vs.models["pool"].compute_pools(db.fetch_all("pool", rbac="edit"))
 
     def update_database_configurations_from_git(self, force_update=False):
         path = vs.path / "network_data"
@@ -1472,13 +1605,17 @@ class Controller:
                 with open(filepath) as file:
                     setattr(device, property, file.read())
         db.session.commit()
-        for pool in db.fetch_all("pool"):
+        if vs.settings["pools"]["incremental_update"]:
+            return
+        pools = [
+            pool
+            for pool in db.fetch_all("pool")
             if any(
                 getattr(pool, f"device_{property}")
                 for property in vs.configuration_properties
-            ):
-                pool.compute_pool()
-        db.session.commit()
+            )
+        ]
+        vs.models["pool"].compute_pools(pools)
 
     def update_device_rbac(self):
         for group in db.fetch_all("group"):
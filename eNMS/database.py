@@ -18,6 +18,7 @@ from sqlalchemy import (
     Float,
     inspect,
     Integer,
+    LargeBinary,
     PickleType,
     String,
     Table,
@@ -162,6 +163,10 @@ class Database:
             if self.dialect.startswith(("mariadb", "mysql")):
                 impl = MSMediumBlob
 
+        if self.dialect.startswith(("mariadb", "mysql")):
+            self.LargeBinary = MSMediumBlob
+        else:
+            self.LargeBinary = LargeBinary
         self.Dict = MutableDict.as_mutable(CustomPickleType)
         self.List = MutableList.as_mutable(CustomPickleType)
         if self.dialect == "postgresql":
@@ -247,31 +252,35 @@ class Database:
 
         @event.listens_for(self.base, "before_update", propagate=True)
         def log_instance_update(mapper, connection, target):
-            if not env.log_events:
+            if (
+                not env.log_events
+                or getattr(target, "private", False)
+                or not getattr(target, "log_change", True)
+            ):
                 return
             state, changelog = inspect(target), []
-            for attr in state.attrs:
-                hist = state.get_history(attr.key, True)
+            for property in list(state.committed_state):
                 if (
-                    getattr(target, "private", False)
-                    or not getattr(target, "log_change", True)
-                    or not getattr(state.class_, attr.key).info.get("log_change", True)
-                    or attr.key in vs.private_properties_set
-                    or not hist.has_changes()
+                    not getattr(state.class_, property).info.get("log_change", True)
+                    or property in vs.private_properties_set
                 ):
                     continue
-                change = f"{attr.key}: "
-                property_type = type(getattr(target, attr.key))
+                hist = state.get_history(property, True)
+                if not hist.has_changes():
+                    continue
+                change = f"{property}: "
+                property_type = type(getattr(target, property))
                 if property_type in (InstrumentedList, MutableList):
                     if property_type == MutableList:
-                        added = [x for x in hist.added[0] if x not in hist.deleted[0]]
-                        deleted = [x for x in hist.deleted[0] if x not in hist.added[0]]
+                        new = hist.added[0] if hist.added else []
+                        old = hist.deleted[0] if hist.deleted else []
+                        added, deleted = difference(new, old), difference(old, new)
                     else:
                         added, deleted = hist.added, hist.deleted
                     if deleted:
-                        change += f"DELETED: {deleted}"
+                        change += f"DELETED: {summarize(deleted)}"
                     if added:
-                        change += f"{' / ' if deleted else ''}ADDED: {added}"
+                        change += f"{' / ' if deleted else ''}ADDED: {summarize(added)}"
                 else:
                     change += (
                         f"'{hist.deleted[0] if hist.deleted else None}' => "
@@ -285,10 +294,58 @@ class Database:
                 )
                 env.log("info", f"UPDATE: {target.type} '{name}': ({changes})")
 
+        def difference(values, other_values):
+            try:
+                other_values = set(other_values)
+            except TypeError:
+                pass
+            return [value for value in values if value not in other_values]
+
+        def summarize(values):
+            if len(values) > vs.settings["changelog"]["max_diff_items"]:
+                return f"{len(values)} items"
+            return values
+
         for model in vs.models.values():
             if "configure_events" in vars(model):
                 model.configure_events()
 
+        def register_rbac_change(model, instance):
+            changes = self.session().info.setdefault("rbac_changes", set())
+            changes.add(f"{model}/{instance.id}")
+
+        device = vs.models["device"]
+
+        @event.listens_for(device.rbac_target, "append")
+        @event.listens_for(device.rbac_target, "remove")
+        def device_target_update(_, group, __):
+            register_rbac_change("group", group)
+
+        @event.listens_for(vs.models["group"].rbac_target_devices, "append")
+        @event.listens_for(vs.models["group"].rbac_target_devices, "remove")
+        def group_target_update(group, *_):
+            register_rbac_change("group", group)
+
+        @event.listens_for(device.owners, "append")
+        @event.listens_for(device.owners, "remove")
+        def device_owner_update(_, user, __):
+            register_rbac_change("user", user)
+
+        @event.listens_for(vs.models["user"].user_devices, "append")
+        @event.listens_for(vs.models["user"].user_devices, "remove")
+        def user_device_update(user, *_):
+            register_rbac_change("user", user)
+
+        @event.listens_for(self.session.session_factory, "after_commit")
+        def update_rbac_versions(session):
+            changes = session.info.pop("rbac_changes", None)
+            if changes:
+                env.update_rbac_versions(changes)
+
+        @event.listens_for(self.session.session_factory, "after_rollback")
+        def discard_rbac_changes(session):
+            session.info.pop("rbac_changes", None)
+
         if env.use_vault:
             for model in vs.private_properties:
 
@@ -296,8 +353,10 @@ class Database:
                 def vault_update(target, new_name, old_name, *_):
                     if new_name == old_name:
                         return
+                    path = f"secret/data/{target.type}"
+                    env.invalidate_secrets(f"{path}/{old_name}/")
+                    env.invalidate_secrets(f"{path}/{new_name}/")
                     for property in vs.private_properties[target.class_type]:
-                        path = f"secret/data/{target.type}"
                         data = env.vault_client.read(f"{path}/{old_name}/{property}")
                         if not data:
                             return
@@ -459,6 +518,17 @@ class Database:
     def fetch_all(self, model, **kwargs):
         return self.fetch(model, allow_none=True, all_matches=True, **kwargs)
 
+    def fetch_in(self, model, property, values, rbac="read", username=None):
+        query, instances = self.query(model, rbac, username=username), []
+        if not query:
+            return instances
+        column, values = getattr(vs.models[model], property), list(values)
+        chunk_size = self.transactions["chunk_size"]
+        for index in range(0, len(values), chunk_size):
+            chunk = values[index : index + chunk_size]
+            instances.extend(query.filter(column.in_(chunk)).all())
+        return instances
+
     def objectify(self, model, object_list, **kwargs):
         return [self.fetch(model, id=object_id, **kwargs) for object_id in object_list]
 
@@ -547,6 +617,28 @@ class Database:
             raise Exception(f"No matching credentials found for DEVICE '{device.name}'")
         return credentials
 
+    def get_device_credentials(self, username, device_names, credential_type="any"):
+        credential_model, device_model = vs.models["credential"], vs.models["device"]
+        query = (
+            self.session.query(credential_model, device_model.name)
+            .join(vs.models["group"], credential_model.groups)
+            .join(vs.models["user"], vs.models["group"].users)
+            .join(vs.models["pool"], credential_model.device_pools)
+            .join(device_model, vs.models["pool"].devices)
+            .filter(vs.models["user"].name == username)
+        )
+        if credential_type != "any":
+            query = query.filter(credential_model.role == credential_type)
+        credentials, device_names = dict.fromkeys(device_names), list(device_names)
+        chunk_size = self.transactions["chunk_size"]
+        for index in range(0, len(device_names), chunk_size):
+            chunk = device_names[index : index + chunk_size]
+            for credential, name in query.filter(device_model.name.in_(chunk)):
+                best = credentials[name]
+                if not best or credential.priority > best.priority:
+                    credentials[name] = credential
+        return credentials
+
     def register_custom_models(self):
         for model in ("device", "link", "service"):
             paths = [vs.path / "eNMS" / "models" / f"{model}s"]
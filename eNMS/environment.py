@@ -1,3 +1,4 @@
+from atexit import register
 from base64 import b64decode, b64encode
 from click import get_current_context
 from collections import defaultdict
@@ -10,13 +11,16 @@ from email.mime.text import MIMEText
 from email.utils import formatdate
 from flask_login import current_user
 from importlib import import_module
-from json import load
+from itertools import islice
+from json import dumps, load, loads
 from logging.config import dictConfig
-from logging import getLogger, info
-from os import getenv, getpid
+from logging import error, getLogger, info, warning
+from multiprocessing.pool import ThreadPool
+from os import getenv, getpid, register_at_fork
 from passlib.hash import argon2
 from pathlib import Path
 from psutil import Process
+from queue import Empty, Full, Queue
 from redis import Redis
 from redis.exceptions import ConnectionError, TimeoutError
 from requests import Session as RequestSession
@@ -26,7 +30,9 @@ from smtplib import SMTP
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import StaleDataError
 from sys import path as sys_path
-from threading import Thread
+from tempfile import gettempdir
+from threading import RLock, Thread
+from time import sleep, time
 from traceback import format_exc
 from warnings import warn
 from watchdog.observers.polling import PollingObserver
@@ -61,6 +67,7 @@ class Environment:
         if vs.settings["paths"]["custom_code"]:
             sys_path.append(vs.settings["paths"]["custom_code"])
         self.init_logs()
+        self.init_changelog_writer()
         self.init_redis()
         if vs.settings["automation"]["use_task_queue"]:
             self.init_dramatiq()
@@ -218,12 +225,91 @@ class Environment:
 
     def init_redis(self):
         host = getenv("REDIS_ADDR")
+        self.state_buffer, self.state_lock = defaultdict(dict), RLock()
         if not host:
             self.redis_queue = None
         else:
             self.redis_queue = Redis(host=host, **vs.settings["redis"]["config"])
             if vs.settings["redis"]["flush_on_restart"]:
                 self.redis_queue.flushdb()
+            self.update_state_version = self.redis_queue.register_script(
+                "local version = redis.call('INCR', KEYS[1]) "
+                "for _, key in ipairs(ARGV) do "
+                "redis.call('ZADD', KEYS[2], version, key) end "
+                "return version"
+            )
+            self.start_state_flusher()
+            register_at_fork(after_in_child=self.start_state_flusher)
+
+    def start_state_flusher(self):
+        self.state_buffer, self.state_lock = defaultdict(dict), RLock()
+        state_thread = Thread(target=self.flush_state_periodically)
+        state_thread.daemon = True
+        state_thread.start()
+
+    def write_state(self, runtime, key, value, method=None):
+        operation = {None: "hset", "append": "lpush", "increment": "hincrby"}[method]
+        with self.state_lock:
+            pending = self.state_buffer[runtime].get(key)
+            if pending and pending[0] != operation:
+                self.flush_state(runtime)
+                pending = None
+            if operation == "hincrby":
+                value += pending[1] if pending else 0
+            elif operation == "lpush":
+                value = (pending[1] if pending else []) + [value]
+            self.state_buffer[runtime][key] = (operation, value)
+
+    def flush_state(self, runtime=None):
+        with self.state_lock:
+            runtimes = [runtime] if runtime else list(self.state_buffer)
+            pipeline = self.redis_queue.pipeline()
+            for runtime in runtimes:
+                buffer = self.state_buffer.pop(runtime, {})
+                if not buffer:
+                    continue
+                changes = []
+                for key, (operation, value) in buffer.items():
+                    if operation == "lpush":
+                        pipeline.lpush(f"{runtime}/state/{key}", *value)
+                        pipeline.sadd(f"{runtime}/keys", f"{runtime}/state/{key}")
+                    else:
+                        getattr(pipeline, operation)(f"{runtime}/state", key, value)
+                        changes.append(key)
+                self.update_state_version(
+                    keys=[f"{runtime}/version", f"{runtime}/changes"],
+                    args=changes,
+                    client=pipeline,
+                )
+            try:
+                pipeline.execute()
+            except (ConnectionError, TimeoutError) as exc:
+                self.log("error", f"Redis Queue Unreachable ({exc})", change_log=False)
+
+    def get_rbac_versions(self, keys):
+        if self.redis_queue:
+            versions = self.redis("hmget", "rbac/versions", *keys) or [None] * len(keys)
+        else:
+            versions = [vs.rbac_versions[key] for key in keys]
+        return {key: int(version or 0) for key, version in zip(keys, versions)}
+
+    def update_rbac_versions(self, keys):
+        if self.redis_queue:
+            pipeline = self.redis_queue.pipeline(transaction=False)
+            for key in keys:
+                pipeline.hincrby("rbac/versions", key, 1)
+            try:
+                pipeline.execute()
+            except (ConnectionError, TimeoutError) as exc:
+                self.log("error", f"Redis Queue Unreachable ({exc})", change_log=False)
+        else:
+            for key in keys:
+                vs.rbac_versions[key] += 1
+
+    def flush_state_periodically(self):
+        while True:
+            sleep(vs.settings["redis"]["state_flush_interval"])
+            self.flush_state()
 
     def init_vault_client(self):
         url = getenv("VAULT_ADDR", "http://127.0.0.1:8200")
@@ -231,6 +317,44 @@ class Environment:
         if self.vault_client.sys.is_sealed() and vs.settings["vault"]["unseal_vault"]:
             keys = [getenv(f"UNSEAL_VAULT_KEY{index}") for index in range(1, 6)]
             self.vault_client.sys.submit_unseal_keys(filter(None, keys))
+        self.vault_cache = {}
+
+    def read_secret(self, path, property):
+        value, expiry = self.vault_cache.get(path, (None, 0))
+        if expiry > time():
+            return value
+        data = self.vault_client.read(path)
+        value = data["data"]["data"][property] if data else ""
+        cache_ttl = vs.settings["vault"]["cache_ttl"]
+        if cache_ttl:
+            self.vault_cache[path] = (value, time() + cache_ttl)
+        return value
+
+    def write_secret(self, path, property, value):
+        self.vault_client.write(path, data={property: value})
+        self.vault_cache.pop(path, None)
+
+    def invalidate_secrets(self, prefix):
+        for path in list(self.vault_cache):
+            if path.startswith(prefix):
+                self.vault_cache.pop(path, None)
+
+    def prefetch_secrets(self, instances):
+        secrets = [
+            (f"secret/data/{instance.type}/{instance.name}/{property}", property)
+            for instance in instances
+            for property in vs.private_properties[instance.class_type]
+        ]
+        secrets = [
+            (path, property)
+            for path, property in secrets
+            if self.vault_cache.get(path, (None, 0))[1] <= time()
+        ]
+        if not secrets or not vs.settings["vault"]["cache_ttl"]:
+            return
+        threads = min(len(secrets), vs.settings["vault"]["prefetch_threads"])
+        with ThreadPool(processes=threads) as pool:
+            pool.starmap(self.read_secret, secrets)
 
     def get_workers(self):
         return {worker.name: worker.to_dict() for worker in db.fetch_all("worker")}
@@ -240,19 +364,82 @@ class Environment:
         if logger:
             getattr(getLogger(logger), severity)(content)
         if change_log or logger and logger_settings.get("change_log"):
-            db.factory(
-                "changelog",
-                **{
-                    "severity": severity,
-                    "content": content,
-                    "user": user or getattr(current_user, "name", ""),
-                },
-            )
+            changelog = {
+                "type": "changelog",
+                "time": vs.get_time(),
+                "severity": severity,
+                "content": content,
+                "user": user or getattr(current_user, "name", ""),
+            }
+            if getpid() != self.changelog_pid:
+                self.write_changelogs([changelog])
+            else:
+                try:
+                    timeout = vs.settings["changelog"]["timeout"]
+                    self.changelog_queue.put(changelog, timeout=timeout)
+                except Full:
+                    self.write_changelogs([changelog])
         return logger_settings
 
+    def init_changelog_writer(self):
+        self.start_changelog_writer()
+        register_at_fork(after_in_child=self.start_changelog_writer)
+        register(self.flush_changelogs)
+
+    def start_changelog_writer(self):
+        self.changelog_queue = Queue(vs.settings["changelog"]["queue_size"])
+        self.changelog_pid = getpid()
+        changelog_thread = Thread(target=self.process_changelog_queue)
+        changelog_thread.daemon = True
+        changelog_thread.start()
+
+    def process_changelog_queue(self):
+        settings = vs.settings["changelog"]
+        while True:
+            changelogs, start_time = [self.changelog_queue.get()], time()
+            while len(changelogs) < settings["batch_size"]:
+                timeout = settings["flush_interval"] - (time() - start_time)
+                if timeout <= 0:
+                    break
+                try:
+                    changelogs.append(self.changelog_queue.get(timeout=timeout))
+                except Empty:
+                    break
+            self.write_changelogs(changelogs)
+
+    def flush_changelogs(self):
+        changelogs = []
+        while True:
+            try:
+                changelogs.append(self.changelog_queue.get_nowait())
+            except Empty:
+                break
+        batch_size = vs.settings["changelog"]["batch_size"]
+        for index in range(0, len(changelogs), batch_size):
+            self.write_changelogs(changelogs[index : index + batch_size])
+
+    def write_changelogs(self, changelogs):
+        table = vs.models["changelog"].__table__
+        for index in range(db.retry_commit_number):
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(table.insert(), changelogs)
+                return
+            except Exception as exc:
+                if index == db.retry_commit_number - 1:
+                    error(
+                        f"Failed to write {len(changelogs)} changelogs "
+                        f"({format_exc()}):\n{dumps(changelogs)}"
+                    )
+                else:
+                    warning(f"Changelog write n°{index} failed ({exc})")
+                    sleep(db.retry_commit_time * (index + 1))
+
     def log_queue(self, runtime, service, log=None, mode="add", start_line=0):
         if self.redis_queue:
             key = f"{runtime}/{service}/logs"
+            if int(service) not in vs.run_logs[runtime]:
+                self.redis("sadd", f"{runtime}/keys", key)
             vs.run_logs[runtime][int(service)] = None
             if mode == "add":
                 log = self.redis("lpush", key, log)
@@ -260,14 +447,59 @@ class Environment:
                 log = self.redis("lrange", key, 0, -1)
                 if log:
                     log = log[::-1][start_line:]
+        elif mode == "add":
+            return self.add_log(runtime, int(service), log)
         else:
-            if mode == "add":
-                return vs.run_logs[runtime][int(service)].append(log)
-            else:
-                full_log = getattr(vs.run_logs[runtime], mode)(int(service), [])
-                log = full_log[start_line:]
+            log = self.read_logs(runtime, int(service), start_line)
+            if mode == "pop":
+                self.clear_logs(runtime, int(service))
         return log
 
+    def add_log(self, runtime, service, log):
+        logs = vs.run_logs[runtime][service]
+        max_lines = vs.settings["automation"]["log_memory_lines"]
+        logs.append(log)
+        if len(logs) < max_lines:
+            return
+        with vs.run_logs_lock:
+            spilled_lines = logs[: len(logs) - max_lines // 2]
+            if not spilled_lines:
+                return
+            with open(self.get_log_path(runtime, service), "a") as file:
+                file.writelines(f"{dumps(line)}\n" for line in spilled_lines)
+            spills = vs.run_log_spills[runtime]
+            spills[service] = spills.get(service, 0) + len(spilled_lines)
+            del logs[: len(spilled_lines)]
+
+    def read_logs(self, runtime, service, start_line=0):
+        with vs.run_logs_lock:
+            spilled = vs.run_log_spills.get(runtime, {}).get(service, 0)
+            logs, lines = list(vs.run_logs[runtime].get(service, [])), []
+            if start_line < spilled:
+                with open(self.get_log_path(runtime, service)) as file:
+                    lines = [
+                        loads(line) for line in islice(file, start_line, spilled)
+                    ]
+        return lines + logs[max(start_line - spilled, 0) :]
+
+    def clear_logs(self, runtime, service=None):
+        with vs.run_logs_lock:
+            if service is None:
+                services = list(vs.run_logs.pop(runtime, {}))
+                spills = vs.run_log_spills.pop(runtime, {})
+            else:
+                services = [service]
+                vs.run_logs.get(runtime, {}).pop(service, None)
+                spills = {service: vs.run_log_spills[runtime].pop(service, None)}
+            for service in services:
+                if spills.get(service):
+                    self.get_log_path(runtime, service).unlink()
+
+    def get_log_path(self, runtime, service):
+        path = Path(gettempdir()) / "eNMS"
+        path.mkdir(exist_ok=True)
+        return path / f"{vs.strip_all(runtime)}-{getpid()}-{service}.log"
+
     def redis(self, operation, *args, **kwargs):
         try:
             return getattr(self.redis_queue, operation)(*args, **kwargs)
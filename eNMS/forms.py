@@ -696,6 +696,12 @@ class ServiceForm(BaseForm):
     )
     target_devices = MultipleInstanceField("Devices", model="device")
     disable_result_creation = BooleanField("Save only failed results")
+    result_retention_days = IntegerField(
+        "Delete Results older than (in days, 0 to keep all)", default=0
+    )
+    result_retention_runs = IntegerField(
+        "Maximum number of Runs kept (0 to keep all)", default=0
+    )
     target_pools = MultipleInstanceField("Pools", model="pool")
     update_target_pools = BooleanField("Update target pools before running")
     update_pools_after_running = BooleanField("Update pools after running")
@@ -818,6 +824,12 @@ class ServiceForm(BaseForm):
     )
     multiprocessing = BooleanField("Multiprocessing", help="common/multiprocessing")
     max_processes = IntegerField("Maximum number of processes", default=15)
+    multiprocessing_mode = SelectField(
+        "Multiprocessing Mode",
+        choices=(("thread", "Thread Pool"), ("process", "Process Pool")),
+        help="common/multiprocessing",
+        no_search=True,
+    )
     validation_condition = SelectField(
         choices=(
             ("none", "No validation"),
@@ -883,6 +895,8 @@ class ServiceForm(BaseForm):
             "credential_type",
             "log_level",
             "disable_result_creation",
+            "result_retention_days",
+            "result_retention_runs",
             "update_pools_after_running",
         ],
         "step1-2": [
@@ -906,6 +920,7 @@ class ServiceForm(BaseForm):
             "device_query_property",
             "multiprocessing",
             "max_processes",
+            "multiprocessing_mode",
         ],
         "step3-2": [
             "iteration_devices",
@@ -967,6 +982,14 @@ class ServiceForm(BaseForm):
                 "Multiprocessing can only be enabled if the run method"
                 " is set to 'Per Device'."
             )
+        invalid_process_pool_error = (
+            self.multiprocessing_mode.data == "process"
+            and self.form_type.data == "workflow"
+        )
+        if invalid_process_pool_error:
+            self.multiprocessing_mode.errors.append(
+                "The process pool mode is not available for workflows."
+            )
         forbidden_name_error = self.scoped_name.data in ("Start", "End", "Placeholder")
         if forbidden_name_error:
             self.name.errors.append("This name is not allowed.")
@@ -1011,6 +1034,7 @@ class ServiceForm(BaseForm):
             valid_form
             and not conversion_validation_mismatch
             and not invalid_multiprocessing_error
+            and not invalid_process_pool_error
             and not empty_validation
             and not forbidden_name_error
             and not no_recipient_error
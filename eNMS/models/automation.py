@@ -1,13 +1,16 @@
 from copy import deepcopy
 from flask_login import current_user
 from functools import wraps
+from hashlib import sha256
 from os import environ, getpid
+from pickle import dumps, loads
 from requests import get, post
 from requests.exceptions import ConnectionError, MissingSchema, ReadTimeout
-from sqlalchemy import Boolean, case, ForeignKey, Integer
+from sqlalchemy import Boolean, case, ForeignKey, Integer, select
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import deferred, relationship
+from zlib import compress, decompress
 
 from eNMS.controller import controller
 from eNMS.database import db
@@ -41,6 +44,8 @@ class Service(AbstractBase):
     credential_type = db.Column(db.SmallString, default="any")
     positions = db.Column(db.Dict, info={"log_change": False})
     disable_result_creation = db.Column(Boolean, default=False)
+    result_retention_days = db.Column(Integer, default=0)
+    result_retention_runs = db.Column(Integer, default=0)
     restrict_to_owners = db.Column(db.List)
     tasks = relationship("Task", back_populates="service", cascade="all,delete")
     vendor = db.Column(db.SmallString)
@@ -109,6 +114,7 @@ class Service(AbstractBase):
     maximum_runs = db.Column(Integer, default=1)
     multiprocessing = db.Column(Boolean, default=False)
     max_processes = db.Column(Integer, default=5)
+    multiprocessing_mode = db.Column(db.TinyString, default="thread")
     status = db.Column(db.TinyString, default="Idle")
     validation_condition = db.Column(db.TinyString, default="none")
     conversion_method = db.Column(db.TinyString, default="none")
@@ -133,6 +139,7 @@ class Service(AbstractBase):
         if self.name in ("[Shared] Start", "[Shared] End", "[Shared] Placeholder"):
             return {"log": f"It is not allowed to delete '{self.name}'."}
         self.check_restriction_to_owners("edit")
+        self.update_last_modified_properties()
 
     def check_restriction_to_owners(self, mode):
         if (
@@ -174,6 +181,7 @@ class Service(AbstractBase):
         for ancestor in self.get_ancestors():
             ancestor.last_modified = self.last_modified
             ancestor.last_modified_by = self.last_modified_by
+            vs.workflow_graphs.pop(ancestor.id, None)
 
     def get_ancestors(self):
         def rec(service):
@@ -242,7 +250,8 @@ class Result(AbstractBase):
     labels = db.Column(db.LargeString)
     runtime = db.Column(db.TinyString)
     duration = db.Column(db.TinyString)
-    result = deferred(db.Column(db.Dict))
+    summary = deferred(db.Column("result", db.Dict))
+    blob_id = db.Column(db.TinyString)
     creator = db.Column(db.SmallString)
     run_id = db.Column(Integer, ForeignKey("run.id", ondelete="cascade"))
     run = relationship("Run", back_populates="results", foreign_keys="Result.run_id")
@@ -272,6 +281,7 @@ class Result(AbstractBase):
     workflow_name = association_proxy(
         "workflow", "scoped_name", info={"name": "workflow_name"}
     )
+    model_properties = {"result": "dict"}
 
     def __getitem__(self, key):
         return self.result[key]
@@ -285,6 +295,51 @@ class Result(AbstractBase):
     def __repr__(self):
         return f"SERVICE '{self.service}' - DEVICE '{self.device} ({self.runtime})"
 
+    @property
+    def result(self):
+        if not self.blob_id:
+            return self.summary
+        if getattr(self, "_result", None) is None:
+            blob = db.fetch("result_blob", id=self.blob_id, rbac=None)
+            self._result = loads(decompress(blob.content))
+        return self._result
+
+    @result.setter
+    def result(self, value):
+        row = self.prepare(value, self.serialize(value))
+        if row["blob_id"]:
+            self.store_blobs({row["blob_id"]: row.pop("blob")})
+        self.summary, self.blob_id, self._result = row["result"], row["blob_id"], None
+
+    @staticmethod
+    def serialize(result):
+        return dumps(result)
+
+    @staticmethod
+    def prepare(result, data):
+        if len(data) < vs.settings["automation"]["results"]["compression_threshold"]:
+            return {"result": result, "blob_id": None}
+        content = compress(data)
+        summary = {key: result.get(key) for key in ("duration", "runtime", "success")}
+        blob_id = sha256(content).hexdigest()
+        return {"result": summary, "blob_id": blob_id, "blob": content}
+
+    @staticmethod
+    def store_blobs(blobs):
+        table, blob_ids = vs.models["result_blob"].__table__, list(blobs)
+        chunk_size = db.transactions["chunk_size"]
+        for index in range(0, len(blob_ids), chunk_size):
+            chunk = blob_ids[index : index + chunk_size]
+            query = select(table.c.id).where(table.c.id.in_(chunk))
+            existing_blobs = set(db.session.execute(query).scalars())
+            values = [
+                {"id": blob_id, "content": blobs[blob_id]}
+                for blob_id in chunk
+                if blob_id not in existing_blobs
+            ]
+            if values:
+                db.session.execute(table.insert(), values)
+
     @classmethod
     def filtering_constraints(cls, **kwargs):
         constraints = []
@@ -295,15 +350,27 @@ class Result(AbstractBase):
         return constraints
 
 
+class ResultBlob(AbstractBase):
+    __tablename__ = type = "result_blob"
+    private = True
+    log_change = False
+    id = db.Column(db.TinyString, primary_key=True)
+    content = deferred(db.Column(db.LargeBinary))
+
+
 class ServiceLog(AbstractBase):
     __tablename__ = type = "service_log"
     private = True
     log_change = False
     id = db.Column(Integer, primary_key=True)
     content = db.Column(db.LargeString)
-    runtime = db.Column(db.TinyString)
+    runtime = db.Column(db.TinyString, index=True)
+    sequence = db.Column(Integer, default=0)
+    start_line = db.Column(Integer, default=0)
+    line_count = db.Column(Integer, default=0)
     service_id = db.Column(Integer, ForeignKey("service.id"))
     service = relationship("Service", foreign_keys="ServiceLog.service_id")
+    devices = relationship("Device", secondary=db.service_log_device_table)
 
     def __repr__(self):
         return f"SERVICE '{self.service}' ({self.runtime})"
@@ -411,21 +478,71 @@ class Run(AbstractBase):
         if self.state:
             return self.state
         elif env.redis_queue:
-            keys = env.redis("keys", f"{self.runtime}/state/*")
-            if not keys:
-                return {}
-            data, state = list(zip(keys, env.redis("mget", *keys))), {}
-            for log, value in data:
-                inner_store, (*path, last_key) = state, log.split("/")[2:]
-                for key in path:
-                    inner_store = inner_store.setdefault(key, {})
-                if value in ("False", "True"):
-                    value = value == "True"
-                inner_store[last_key] = value
-            return state
+            env.flush_state(self.runtime)
+            data = env.redis("hgetall", f"{self.runtime}/state") or self.migrate_state()
+            return self.build_state(data.items())
         else:
             return vs.run_states[self.runtime]
 
+    @staticmethod
+    def build_state(data):
+        state = {}
+        for log, value in data:
+            inner_store, (*path, last_key) = state, log.split("/")
+            for key in path:
+                inner_store = inner_store.setdefault(key, {})
+            if value in ("False", "True"):
+                value = value == "True"
+            inner_store[last_key] = value
+        return state
+
+    def get_state_version(self):
+        if self.state:
+            return None
+        elif env.redis_queue:
+            env.flush_state(self.runtime)
+            return int(env.redis("get", f"{self.runtime}/version") or 0)
+        else:
+            return vs.run_state_versions[self.runtime]["version"]
+
+    def get_state_delta(self, version):
+        current_version = self.get_state_version()
+        if current_version is None:
+            return None, self.state
+        elif env.redis_queue:
+            changes = f"{self.runtime}/changes"
+            keys = env.redis("zrangebyscore", changes, f"({version}", "+inf") or []
+            if not keys:
+                return current_version, {}
+            values = env.redis("hmget", f"{self.runtime}/state", *keys) or []
+            return current_version, self.build_state(zip(keys, values))
+        else:
+            with vs.run_state_lock:
+                changes = vs.run_state_versions[self.runtime]["changes"]
+                keys = [key for key, value in changes.items() if value > version]
+            data = []
+            for key in keys:
+                value = vs.run_states[self.runtime]
+                for path in key.split("/"):
+                    value = value.get(path, {})
+                data.append((key, value))
+            return current_version, self.build_state(data)
+
+    def migrate_state(self):
+        data, legacy_keys, marker = {}, [], f"{self.runtime}/state_migrated"
+        if not env.redis("set", marker, 1, nx=True):
+            return data
+        env.redis("sadd", f"{self.runtime}/keys", marker)
+        for key in env.redis("scan_iter", match=f"{self.runtime}/state/*") or []:
+            if env.redis("type", key) != "string":
+                continue
+            legacy_keys.append(key)
+            data[key.split("/", 2)[2]] = env.redis("get", key)
+        if data:
+            env.redis("hset", f"{self.runtime}/state", mapping=data)
+            env.redis("unlink", *legacy_keys)
+        return data
+
     @property
     def progress(self):
         progress = self.get_state().get(str(self.service_id), {}).get("progress")
@@ -450,12 +567,7 @@ class Run(AbstractBase):
         worker.current_runs = 1 if not worker.current_runs else worker.current_runs + 1
         server.current_runs += 1
         self.worker = worker
-        vs.run_targets[self.runtime] = set(
-            device.id
-            for device in controller.filtering(
-                "device", properties=["id"], rbac="target", username=self.creator
-            )
-        )
+        vs.run_targets[self.runtime] = controller.get_target_devices(self.creator)
         if not self.trigger:
             run_type = "Parameterized" if self.parameterized_run else "Regular"
             self.trigger = f"{run_type} Run"
@@ -28,8 +28,7 @@ class AbstractBase(db.base):
             if env.use_vault:
                 target = self.service if self.type == "run" else self
                 path = f"secret/data/{target.type}/{target.name}/{property}"
-                data = env.vault_client.read(path)
-                value = data["data"]["data"][property] if data else ""
+                value = env.read_secret(path, property)
             else:
                 value = super().__getattribute__(property)
             return value
@@ -42,9 +41,8 @@ class AbstractBase(db.base):
                 return
             value = env.encrypt_password(value).decode("utf-8")
             if env.use_vault:
-                env.vault_client.write(
-                    f"secret/data/{self.type}/{self.name}/{property}",
-                    data={property: value},
+                env.write_secret(
+                    f"secret/data/{self.type}/{self.name}/{property}", property, value
                 )
             else:
                 super().__setattr__(property, value)
@@ -1,5 +1,22 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import chain
+from json import dumps, loads
 from re import search, sub
-from sqlalchemy import and_, Boolean, event, ForeignKey, Integer, or_
+from sqlalchemy import (
+    and_,
+    Boolean,
+    case,
+    event,
+    ForeignKey,
+    func,
+    inspect,
+    Integer,
+    or_,
+    select,
+    update,
+)
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import backref, deferred, relationship
 from sqlalchemy.schema import UniqueConstraint
@@ -7,6 +24,7 @@ from sqlalchemy.schema import UniqueConstraint
 from eNMS.controller import controller
 from eNMS.models.base import AbstractBase
 from eNMS.database import db
+from eNMS.environment import env
 from eNMS.variables import vs
 
 
@@ -273,6 +291,12 @@ class Link(Object):
 class Pool(AbstractBase):
     __tablename__ = type = class_type = "pool"
     models = ("device", "link")
+    proxy_dependencies = {
+        "link": {
+            "source_name": {"source", "source_id"},
+            "destination_name": {"destination", "destination_id"},
+        }
+    }
     id = db.Column(Integer, primary_key=True)
     name = db.Column(db.SmallString, unique=True)
     manually_defined = db.Column(Boolean, default=False)
@@ -308,6 +332,181 @@ class Pool(AbstractBase):
                 number = getattr(target, f"{value.class_type}_number")
                 setattr(target, f"{value.class_type}_number", number - 1)
 
+        if vs.settings["pools"]["incremental_update"]:
+            env.pool_events = True
+            event.listen(db.session.session_factory, "after_flush", cls.update_pools)
+
+    @classmethod
+    def update_pools(cls, session, _):
+        if not env.pool_events:
+            return
+        changes = defaultdict(dict)
+        for instance in chain(session.new, session.dirty):
+            model = getattr(instance, "class_type", None)
+            if model not in cls.models:
+                continue
+            if instance in session.new:
+                changes[model][instance.id] = None
+                continue
+            state = inspect(instance)
+            changed_properties = {
+                property
+                for property in state.committed_state
+                if state.attrs[property].history.has_changes()
+            }
+            for proxy, dependencies in cls.proxy_dependencies.get(model, {}).items():
+                if changed_properties & dependencies:
+                    changed_properties.add(proxy)
+            properties = changed_properties & set(vs.properties["filtering"][model])
+            if properties:
+                changes[model].setdefault(instance.id, set())
+                if changes[model][instance.id] is not None:
+                    changes[model][instance.id] |= properties
+            if model == "device" and "name" in changed_properties:
+                link = vs.models["link"]
+                for side in ("source", "destination"):
+                    column = getattr(link, f"{side}_id")
+                    link_ids = session.execute(
+                        select(link.id).where(column == instance.id)
+                    ).scalars()
+                    for link_id in link_ids:
+                        changes["link"].setdefault(link_id, set())
+                        if changes["link"][link_id] is not None:
+                            changes["link"][link_id].add(f"{side}_name")
+        if not changes:
+            return
+        pool_table = cls.__table__
+        pools = session.execute(
+            select(pool_table).where(pool_table.c.manually_defined.isnot(True))
+        ).all()
+        for model, instances in changes.items():
+            table, predicates = getattr(db, f"pool_{model}_table"), {}
+            for pool in pools:
+                form = cls.get_filtering_form(model, pool)
+                if not form:
+                    continue
+                constraints = controller.filtering_base_constraints(model, form=form)
+                predicates[pool.id] = (set(form), and_(*constraints))
+            for instance_id, properties in instances.items():
+                affected = {
+                    pool_id: predicate
+                    for pool_id, (pool_properties, predicate) in predicates.items()
+                    if properties is None or pool_properties & properties
+                }
+                if not affected:
+                    continue
+                evaluation = (
+                    select(
+                        *(
+                            case((predicate, True), else_=False)
+                            for predicate in affected.values()
+                        )
+                    )
+                    .select_from(vs.models[model])
+                    .where(vs.models[model].id == instance_id)
+                )
+                row = session.execute(evaluation).first()
+                if not row:
+                    continue
+                instance_column = table.c[f"{model}_id"]
+                members = set(
+                    session.execute(
+                        select(table.c.pool_id).where(instance_column == instance_id)
+                    ).scalars()
+                )
+                matches = {pool_id for pool_id, match in zip(affected, row) if match}
+                added, removed = matches - members, (set(affected) - matches) & members
+                if added:
+                    session.execute(
+                        table.insert(),
+                        [
+                            {"pool_id": pool_id, f"{model}_id": instance_id}
+                            for pool_id in added
+                        ],
+                    )
+                if removed:
+                    session.execute(
+                        table.delete().where(
+                            instance_column == instance_id,
+                            table.c.pool_id.in_(removed),
+                        )
+                    )
+                number = pool_table.c[f"{model}_number"]
+                for pool_ids, delta in ((added, 1), (removed, -1)):
+                    if not pool_ids:
+                        continue
+                    session.execute(
+                        update(pool_table)
+                        .where(pool_table.c.id.in_(pool_ids))
+                        .values({number: func.coalesce(number, 0) + delta})
+                    )
+
+    @classmethod
+    def compute_pools(cls, pools):
+        start_time, signatures, timings = datetime.now(), defaultdict(list), {}
+        for pool in pools:
+            if pool.manually_defined:
+                pool.compute_pool()
+                continue
+            timings[pool.name] = 0
+            for model in cls.models:
+                form = cls.get_filtering_form(model, pool)
+                signatures[(model, dumps(form, sort_keys=True))].append(pool)
+
+        def evaluate(model, form):
+            start_time = datetime.now()
+            try:
+                if form:
+                    instances = controller.filtering(
+                        model, properties=["id"], bulk="object", rbac=None, form=form
+                    )
+                else:
+                    instances = []
+                ids = {instance.id for instance in instances}
+                return ids, (datetime.now() - start_time).total_seconds()
+            finally:
+                db.session.remove()
+
+        with ThreadPoolExecutor(vs.settings["pools"]["max_threads"]) as executor:
+            evaluations = {
+                signature: executor.submit(evaluate, signature[0], loads(signature[1]))
+                for signature in signatures
+            }
+        for signature, pool_group in signatures.items():
+            model, (ids, duration) = signature[0], evaluations[signature].result()
+            for pool in pool_group:
+                update_time = datetime.now()
+                pool.update_members(model, ids)
+                setattr(pool, f"{model}_number", len(ids))
+                update_duration = (datetime.now() - update_time).total_seconds()
+                timings[pool.name] += round(duration + update_duration, 3)
+        db.session.commit()
+        total_time = (datetime.now() - start_time).total_seconds()
+        env.log(
+            "info",
+            f"{len(timings)} pools updated with {len(signatures)} distinct "
+            f"filters in {total_time}s",
+        )
+        return {"duration": total_time, "pools": timings}
+
+    @staticmethod
+    def get_filtering_form(model, pool):
+        form = {}
+        for property in vs.properties["filtering"][model]:
+            value = getattr(pool, f"{model}_{property}")
+            match_type = getattr(pool, f"{model}_{property}_match")
+            invert_type = getattr(pool, f"{model}_{property}_invert")
+            if not value and match_type != "empty":
+                continue
+            form.update(
+                {
+                    property: value,
+                    f"{property}_filter": match_type,
+                    f"{property}_invert": invert_type,
+                }
+            )
+        return form
+
     @classmethod
     def database_init(cls):
         for model in cls.models:
@@ -354,36 +553,39 @@ class Pool(AbstractBase):
     def compute_pool(self):
         for model in self.models:
             if not self.manually_defined:
-                kwargs = {"bulk": "object", "rbac": None, "form": {}}
-                for property in vs.properties["filtering"][model]:
-                    value = getattr(self, f"{model}_{property}")
-                    match_type = getattr(self, f"{model}_{property}_match")
-                    invert_type = getattr(self, f"{model}_{property}_invert")
-                    if not value and match_type != "empty":
-                        continue
-                    kwargs["form"].update(
-                        {
-                            property: value,
-                            f"{property}_filter": match_type,
-                            f"{property}_invert": invert_type,
-                        }
-                    )
+                form = self.get_filtering_form(model, self)
+                kwargs = {"bulk": "object", "rbac": None, "form": form}
                 if kwargs["form"]:
                     instances = controller.filtering(model, properties=["id"], **kwargs)
                 else:
                     instances = []
-                table = getattr(db, f"pool_{model}_table")
-                db.session.execute(table.delete().where(table.c.pool_id == self.id))
-                if instances:
-                    values = [
-                        {"pool_id": self.id, f"{model}_id": instance.id}
-                        for instance in instances
-                    ]
-                    db.session.execute(table.insert().values(values))
+                self.update_members(model, {instance.id for instance in instances})
             else:
                 instances = getattr(self, f"{model}s")
             setattr(self, f"{model}_number", len(instances))
 
+    def update_members(self, model, ids):
+        table = getattr(db, f"pool_{model}_table")
+        chunk_size = db.transactions["chunk_size"]
+        pool_column, instance_column = table.c.pool_id, table.c[f"{model}_id"]
+        members = set(
+            db.session.execute(
+                select(instance_column).where(pool_column == self.id)
+            ).scalars()
+        )
+        added, removed = list(ids - members), list(members - ids)
+        for index in range(0, len(added), chunk_size):
+            values = [
+                {"pool_id": self.id, f"{model}_id": instance_id}
+                for instance_id in added[index : index + chunk_size]
+            ]
+            db.session.execute(table.insert(), values)
+        for index in range(0, len(removed), chunk_size):
+            chunk = removed[index : index + chunk_size]
+            db.session.execute(
+                table.delete().where(pool_column == self.id, instance_column.in_(chunk))
+            )
+
 
 class Session(AbstractBase):
     __tablename__ = type = "session"
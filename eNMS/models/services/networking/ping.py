@@ -1,3 +1,6 @@
+from asyncio import create_subprocess_exec, open_connection, wait_for
+from asyncio import TimeoutError as AsyncTimeoutError
+from asyncio.subprocess import PIPE
 from socket import error, gaierror, socket, timeout
 from subprocess import run as sub_run
 from sqlalchemy import ForeignKey, Integer
@@ -22,55 +25,64 @@ class PingService(Service):
 
     __mapper_args__ = {"polymorphic_identity": "ping_service"}
 
+    def get_command(self, ip_address):
+        command = ["ping"]
+        for variable, property in (
+            ("c", "count"),
+            ("W", "timeout"),
+            ("t", "ttl"),
+            ("s", "packet_size"),
+        ):
+            value = getattr(self, property)
+            if value:
+                command.extend(f"-{variable} {value}".split())
+        command.append(ip_address)
+        return command
+
+    def get_ping_results(self, returncode, stdout, stderr):
+        output, result = stdout.decode().strip().splitlines(), None
+        if returncode == 0:
+            # The first ping statistics line can look like either:
+            # - 3 packets transmitted, 0 received, +3 errors,
+            # 100% packet loss, time 2055ms
+            # - 3 packets transmitted, 0 received, 100% packet loss, time 2081ms
+            error_offset = 1 if "errors," in output[-2] else 0
+            sent = output[-2].split(",")[0].split()[0].strip()
+            rcvd = output[-2].split(",")[1].split()[0].strip()
+            if error_offset:
+                errors = output[-2].split(",")[2].split()[0].strip()
+            else:
+                errors = 0
+            total = output[-2].split(",")[3 + error_offset].split()[1].strip()
+            loss = output[-2].split(",")[2 + error_offset].split()[0].strip()
+            timing = output[-1].split()[3].split("/")
+            result = {
+                "probes_sent": sent,
+                "probes_rcvd": rcvd,
+                "errors": errors,
+                "packet_loss": loss,
+                "rtt_min": timing[0],
+                "rtt_max": timing[2],
+                "rtt_avg": timing[1],
+                "rtt_stddev": timing[3],
+                "total rtt": total,
+            }
+        return {
+            "error": stderr.decode().strip(),
+            "output": "\n".join(output),
+            "result": result,
+            "success": returncode == 0,
+        }
+
     def job(self, run, device=None):
         ip_address = run.sub(run.ip_address, locals()) or device.ip_address
         if run.protocol == "ICMP":
-            command = ["ping"]
-            for variable, property in (
-                ("c", "count"),
-                ("W", "timeout"),
-                ("t", "ttl"),
-                ("s", "packet_size"),
-            ):
-                value = getattr(self, property)
-                if value:
-                    command.extend(f"-{variable} {value}".split())
-            command.append(ip_address)
+            command = self.get_command(ip_address)
             run.log("info", f"Running PING ({command})", device)
-            sub_result, result = sub_run(command, capture_output=True), None
-            output = sub_result.stdout.decode().strip().splitlines()
-            if sub_result.returncode == 0:
-                # The first ping statistics line can look like either:
-                # - 3 packets transmitted, 0 received, +3 errors,
-                # 100% packet loss, time 2055ms
-                # - 3 packets transmitted, 0 received, 100% packet loss, time 2081ms
-                error_offset = 1 if "errors," in output[-2] else 0
-                sent = output[-2].split(",")[0].split()[0].strip()
-                rcvd = output[-2].split(",")[1].split()[0].strip()
-                if error_offset:
-                    errors = output[-2].split(",")[2].split()[0].strip()
-                else:
-                    errors = 0
-                total = output[-2].split(",")[3 + error_offset].split()[1].strip()
-                loss = output[-2].split(",")[2 + error_offset].split()[0].strip()
-                timing = output[-1].split()[3].split("/")
-                result = {
-                    "probes_sent": sent,
-                    "probes_rcvd": rcvd,
-                    "errors": errors,
-                    "packet_loss": loss,
-                    "rtt_min": timing[0],
-                    "rtt_max": timing[2],
-                    "rtt_avg": timing[1],
-                    "rtt_stddev": timing[3],
-                    "total rtt": total,
-                }
-            return {
-                "error": sub_result.stderr.decode().strip(),
-                "output": "\n".join(output),
-                "result": result,
-                "success": sub_result.returncode == 0,
-            }
+            sub_result = sub_run(command, capture_output=True)
+            return self.get_ping_results(
+                sub_result.returncode, sub_result.stdout, sub_result.stderr
+            )
         else:
             result = {}
             for port in map(int, run.ports.split(",")):
@@ -85,6 +97,27 @@ class PingService(Service):
                 result[port] = connection
             return {"success": all(result.values()), "result": result}
 
+    async def async_job(self, run, device):
+        ip_address = run.sub(run.ip_address, locals()) or device.ip_address
+        if run.protocol == "ICMP":
+            command = self.get_command(ip_address)
+            run.log("info", f"Running PING ({command})", device)
+            process = await create_subprocess_exec(*command, stdout=PIPE, stderr=PIPE)
+            stdout, stderr = await process.communicate()
+            return self.get_ping_results(process.returncode, stdout, stderr)
+        else:
+            result = {}
+            for port in map(int, run.ports.split(",")):
+                try:
+                    connection = open_connection(ip_address, port)
+                    _, writer = await wait_for(connection, run.timeout)
+                    writer.close()
+                    await writer.wait_closed()
+                    result[port] = True
+                except (AsyncTimeoutError, OSError):
+                    result[port] = False
+            return {"success": all(result.values()), "result": result}
+
 
 class PingForm(ServiceForm):
     form_type = HiddenField(default="ping_service")
@@ -1,5 +1,7 @@
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from heapq import heappop, heappush
+from operator import attrgetter
 from sqlalchemy import Boolean, ForeignKey, Integer
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.schema import UniqueConstraint
@@ -31,6 +33,8 @@ class Workflow(Service):
     man_minutes_type = db.Column(db.TinyString, default="workflow")
     man_minutes = db.Column(Integer, default=0)
     man_minutes_total = db.Column(Integer, default=0)
+    parallel_branches = db.Column(Boolean, default=False)
+    max_parallel_branches = db.Column(Integer, default=5)
     services = relationship(
         "Service",
         secondary=db.service_workflow_table,
@@ -141,57 +145,113 @@ class Workflow(Service):
         ]
         return sum(edges, [])
 
-    def job(self, run, device=None):
-        number_of_runs = defaultdict(int)
+    @property
+    def graph(self):
+        graph = vs.workflow_graphs.get(self.id)
+        if graph and graph["version"] == self.last_modified:
+            return graph
         start = db.fetch("service", scoped_name="Start", rbac=None)
         end = db.fetch("service", scoped_name="End", rbac=None)
+        services, successors = {}, defaultdict(lambda: defaultdict(list))
+        predecessors = defaultdict(set)
+        for service in self.services:
+            services[service.id] = {
+                "maximum_runs": service.maximum_runs,
+                "priority": 1 / service.priority,
+                "skip": service.skip.get(self.name, False),
+                "skip_value": service.skip_value,
+            }
+        for edge in sorted(self.edges, key=attrgetter("id")):
+            successors[edge.source_id][edge.subtype].append(
+                (edge.id, edge.destination_id)
+            )
+            predecessors[edge.destination_id].add(edge.source_id)
+        graph = {
+            "version": self.last_modified,
+            "start": start.id,
+            "end": end.id,
+            "services": services,
+            "successors": {
+                service_id: {
+                    subtype: tuple(edges) for subtype, edges in service_edges.items()
+                }
+                for service_id, service_edges in successors.items()
+            },
+            "predecessors": {
+                service_id: frozenset(sources)
+                for service_id, sources in predecessors.items()
+            },
+        }
+        vs.workflow_graphs[self.id] = graph
+        return graph
+
+    def job(self, run, device=None):
+        number_of_runs, graph = defaultdict(int), self.graph
+        start, end = graph["start"], graph["end"]
         services, targets = [], defaultdict(set)
         start_targets = [device] if device else run.target_devices
-        for service_id in run.start_services or [start.id]:
-            service = db.fetch("service", id=service_id, rbac=None)
-            targets[service.name] |= {device.name for device in start_targets}
-            heappush(services, (1 / service.priority, service))
-        visited, restart_run = set(), run.restart_run
+        for service_id in run.start_services or [start]:
+            service_id = int(service_id)
+            targets[service_id] |= {device.name for device in start_targets}
+            heappush(services, (graph["services"][service_id]["priority"], service_id))
+        visited, restart_run, placeholder = set(), run.restart_run, run.placeholder
+        placeholder_id = getattr(placeholder, "id", None)
         tracking_bfs = run.run_method == "per_service_with_workflow_targets"
-        device_store = {device.name: device for device in start_targets}
-        while services:
-            if run.stop:
-                return {"success": False, "result": "Aborted"}
-            _, service = heappop(services)
-            if number_of_runs[service.name] >= service.maximum_runs:
-                continue
-            number_of_runs[service.name] += 1
-            visited.add(service)
-            if service in (start, end) or service.skip.get(self.name, False):
-                success = service.skip_value == "success"
+
+        def run_service(service_id, target_names, in_thread=False):
+            def get(instance):
+                if not in_thread or instance is None:
+                    return instance
+                return db.session.merge(instance, load=False)
+
+            properties = graph["services"][service_id]
+            if service_id in (start, end) or properties["skip"]:
+                success = properties["skip_value"] == "success"
                 results = {"result": "skipped", "success": success}
                 if tracking_bfs or device:
-                    results["summary"] = {
-                        "success": targets[service.name],
-                        "failure": [],
-                    }
-            else:
-                kwargs = {
-                    "service": run.placeholder
-                    if service.scoped_name == "Placeholder"
-                    else service,
-                    "workflow": self,
-                    "restart_run": restart_run,
-                    "parent": run,
-                    "parent_runtime": run.parent_runtime,
-                    "workflow_run_method": run.run_method,
-                }
-                if tracking_bfs or device:
-                    kwargs["target_devices"] = []
-                    for name in targets[service.name]:
-                        if name not in device_store:
-                            device_store[name] = db.fetch("device", name=name)
-                        kwargs["target_devices"].append(device_store[name])
-                if run.parent_device:
-                    kwargs["parent_device"] = run.parent_device
-                results = Runner(run, payload=run.payload, **kwargs).results
-                if not results:
-                    continue
+                    results["summary"] = {"success": target_names, "failure": []}
+                return results
+            service = db.fetch("service", id=service_id, rbac=None)
+            workflow = self
+            if service.scoped_name == "Placeholder":
+                service = placeholder
+                if in_thread and placeholder_id:
+                    service = db.fetch("service", id=placeholder_id, rbac=None)
+            if in_thread:
+                workflow = db.fetch("workflow", id=self.id, rbac=None)
+            kwargs = {
+                "service": service,
+                "workflow": workflow,
+                "restart_run": get(restart_run),
+                "parent": run,
+                "parent_runtime": run.parent_runtime,
+                "workflow_run_method": run.run_method,
+            }
+            if tracking_bfs or device:
+                kwargs["target_devices"] = []
+                for name in target_names:
+                    kwargs["target_devices"].append(run.get_device("name", name))
+            if run.parent_device:
+                kwargs["parent_device"] = get(run.parent_device)
+            return Runner(run, payload=run.payload, **kwargs).results
+
+        def run_service_in_thread(service_id, target_names):
+            try:
+                return run_service(service_id, target_names, in_thread=True)
+            finally:
+                db.session.remove()
+
+        def dispatch(service_id):
+            maximum_runs = graph["services"][service_id]["maximum_runs"]
+            if number_of_runs[service_id] >= maximum_runs:
+                return False
+            number_of_runs[service_id] += 1
+            visited.add(service_id)
+            return True
+
+        def process_results(service_id, results):
+            if not results:
+                return
             status = "success" if results["success"] else "failure"
             summary = results.get("summary", {})
             if not tracking_bfs and not device:
@@ -201,20 +261,78 @@ class Workflow(Service):
                     continue
                 if (tracking_bfs or device) and not summary[edge_type]:
                     continue
-                for edge in service.neighbors(self, edge_type):
-                    successor = edge.destination
+                successors = graph["successors"].get(service_id, {})
+                for edge_id, successor_id in successors.get(edge_type, ()):
                     if tracking_bfs or device:
-                        targets[successor.name] |= set(summary[edge_type])
-                    heappush(services, ((1 / successor.priority, successor)))
+                        targets[successor_id] |= set(summary[edge_type])
+                    successor_priority = graph["services"][successor_id]["priority"]
+                    heappush(services, (successor_priority, successor_id))
                     if tracking_bfs or device:
                         run.write_state(
-                            f"edges/{edge.id}", len(summary[edge_type]), "increment"
+                            f"edges/{edge_id}", len(summary[edge_type]), "increment"
                         )
                     else:
-                        run.write_state(f"edges/{edge.id}", "DONE")
+                        run.write_state(f"edges/{edge_id}", "DONE")
+
+        if self.parallel_branches:
+            running = {}
+
+            def launch(service_id):
+                if not dispatch(service_id):
+                    return
+                target_names = list(targets[service_id])
+                properties = graph["services"][service_id]
+                if service_id in (start, end) or properties["skip"]:
+                    process_results(service_id, run_service(service_id, target_names))
+                else:
+                    future = executor.submit(
+                        run_service_in_thread, service_id, target_names
+                    )
+                    running[future] = service_id
+
+            with ThreadPoolExecutor(self.max_parallel_branches) as executor:
+                while services or running:
+                    if run.stop:
+                        return {"success": False, "result": "Aborted"}
+                    blocked = []
+                    while services:
+                        priority, service_id = heappop(services)
+                        pending = {
+                            *running.values(),
+                            *(blocked_id for _, blocked_id in blocked),
+                            *(
+                                queued_id
+                                for _, queued_id in services
+                                if number_of_runs[queued_id]
+                                < graph["services"][queued_id]["maximum_runs"]
+                            ),
+                        }
+                        predecessors = graph["predecessors"].get(service_id, set())
+                        if (predecessors - {service_id}) & pending:
+                            blocked.append((priority, service_id))
+                        else:
+                            launch(service_id)
+                    if blocked and not running:
+                        launch(blocked.pop(0)[1])
+                    for item in blocked:
+                        heappush(services, item)
+                    if not running:
+                        continue
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        process_results(running.pop(future), future.result())
+        else:
+            while services:
+                if run.stop:
+                    return {"success": False, "result": "Aborted"}
+                _, service_id = heappop(services)
+                if not dispatch(service_id):
+                    continue
+                results = run_service(service_id, list(targets[service_id]))
+                process_results(service_id, results)
         if tracking_bfs or device:
-            failed = list(targets[start.name] - targets[end.name])
-            summary = {"success": list(targets[end.name]), "failure": failed}
+            failed = list(targets[start] - targets[end])
+            summary = {"success": list(targets[end]), "failure": failed}
             results = {"success": not failed, "summary": summary}
         else:
             results = {"success": end in visited}
@@ -247,6 +365,10 @@ class WorkflowForm(ServiceForm):
         ),
         no_search=True,
     )
+    parallel_branches = BooleanField("Run Independent Branches in Parallel")
+    max_parallel_branches = IntegerField(
+        "Maximum Number of Parallel Branches", [NumberRange(min=1)], default=5
+    )
     man_minutes = IntegerField(
         "Minutes to Complete Task Manually", [NumberRange(min=0)], default=0
     )
@@ -303,8 +425,19 @@ class WorkflowForm(ServiceForm):
                     "run method is set to 'Service by Service'."
                 )
             )
+        too_many_branches_error = (
+            self.parallel_branches.data
+            and self.max_parallel_branches.data
+            > vs.settings["automation"]["max_process"]
+        )
+        if too_many_branches_error:
+            self.max_parallel_branches.errors.append(
+                "The number of parallel branches must be at most "
+                f"{vs.settings['automation']['max_process']}."
+            )
         return valid_form and not any(
             [
+                too_many_branches_error,
                 invalid_man_minutes_type_error,
                 invalid_man_minutes_error,
                 invalid_targets_error,
@@ -355,5 +488,9 @@ class WorkflowEdge(AbstractBase):
         super().update(**kwargs)
         self.set_name(kwargs.get("name"))
 
+    def delete(self):
+        if self.workflow:
+            self.workflow.update_last_modified_properties()
+
     def set_name(self, name=None):
         self.name = name or f"[{self.workflow}] {vs.get_time()}"
@@ -34,6 +34,7 @@ class RestApi:
     }
 
     allowed_endpoints = [
+        "apply_retention_policies",
         "get_cluster_status",
         "get_git_content",
         "update_all_pools",
@@ -100,24 +101,22 @@ class RestApi:
         if run_name and db.fetch("run", name=run_name, allow_none=True, rbac=None):
             return {"error": "There is already a run with the same name."}
         handle_asynchronously = data.get("async", True)
-        for device_name in data.get("devices", ""):
-            device = db.fetch("device", name=device_name, allow_none=True)
-            if device:
-                devices.append(device.id)
-            else:
-                errors.append(f"No device with the name '{device_name}'")
-        for device_ip in data.get("ip_addresses", ""):
-            device = db.fetch("device", ip_address=device_ip, allow_none=True)
-            if device:
-                devices.append(device.id)
-            else:
-                errors.append(f"No device with the IP address '{device_ip}'")
-        for pool_name in data.get("pools", ""):
-            pool = db.fetch("pool", name=pool_name, allow_none=True)
-            if pool:
-                pools.append(pool.id)
-            else:
-                errors.append(f"No pool with the name '{pool_name}'")
+        for model, property, values, label in (
+            ("device", "name", data.get("devices", ""), "name"),
+            ("device", "ip_address", data.get("ip_addresses", ""), "IP address"),
+            ("pool", "name", data.get("pools", ""), "name"),
+        ):
+            if not values:
+                continue
+            instances = db.fetch_in(model, property, set(values))
+            found = {getattr(instance, property) for instance in instances}
+            ids = devices if model == "device" else pools
+            ids.extend(instance.id for instance in instances)
+            errors.extend(
+                f"No {model} with the {label} '{value}'"
+                for value in values
+                if value not in found
+            )
         if errors and not kwargs.get("ignore_invalid_targets"):
             return {"errors": errors}
         if devices or pools:
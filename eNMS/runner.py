@@ -1,12 +1,16 @@
+from asyncio import gather, run as asyncio_run, Semaphore, sleep as async_sleep
 from builtins import __dict__ as builtins
+from collections import defaultdict
+from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime
 from functools import partial
 from importlib import __import__ as importlib_import
 from io import BytesIO, StringIO
 from jinja2 import Template
-from json import dump, load, loads
+from json import dump, dumps, load, loads
 from json.decoder import JSONDecodeError
+from multiprocessing import get_context
 from multiprocessing.pool import ThreadPool
 from napalm import get_network_driver
 from ncclient import manager
@@ -17,9 +21,9 @@ from paramiko import AutoAddPolicy, RSAKey, SFTPClient, SSHClient
 from re import compile, search
 from requests import post
 from scp import SCPClient
-from sys import getsizeof
-from threading import Thread
-from time import sleep
+from sqlalchemy.orm import object_session
+from threading import BoundedSemaphore, Lock, Thread
+from time import sleep, time
 from traceback import format_exc
 from types import GeneratorType
 from warnings import warn
@@ -43,6 +47,10 @@ from eNMS.variables import vs
 
 
 class Runner:
+    device_log_pattern = compile(r" - DEVICE (.+?) - ")
+    result_columns = ("duration", "runtime", "success")
+    optional_result_columns = ("workflow_id", "parent_device_id", "device_id")
+
     def __init__(self, run, **kwargs):
         self.parameterized_run = False
         self.is_main_run = kwargs.pop("is_main_run", False)
@@ -56,6 +64,7 @@ class Runner:
         self.parent_runtime = kwargs.get("parent_runtime")
         self.runtime = self.parent_runtime if self.is_main_run else vs.get_time()
         self.has_result = False
+        self.in_subprocess = False
         vs.run_instances[self.runtime] = self
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -143,18 +152,13 @@ class Runner:
 
     def compute_devices_from_query(_self, query, property, **locals):  # noqa: N805
         values = _self.eval(query, **locals)[0]
-        devices, not_found = set(), []
         if isinstance(values, str):
             values = [values]
-        for value in values:
-            if isinstance(value, vs.models["device"]):
-                device = value
-            else:
-                device = db.fetch("device", allow_none=True, **{property: value})
-            if device:
-                devices.add(device)
-            else:
-                not_found.append(value)
+        devices = {value for value in values if isinstance(value, vs.models["device"])}
+        values = [value for value in values if value not in devices]
+        devices |= set(_self.get_devices(property, values))
+        found = {str(getattr(device, property)) for device in devices}
+        not_found = [str(value) for value in values if str(value) not in found]
         if not_found:
             raise Exception(f"Device query invalid targets: {', '.join(not_found)}")
         return devices
@@ -175,10 +179,13 @@ class Runner:
                 pool.compute_pool()
             devices |= set(pool.devices)
         db.session.commit()
+        for device in devices:
+            self.cache_device(device)
+        run_targets = vs.run_targets[self.parent_runtime]
         restricted_devices = set(
             device
             for device in devices
-            if device.id not in vs.run_targets[self.parent_runtime]
+            if run_targets is not None and device.id not in run_targets
         )
         if restricted_devices:
             result = (
@@ -188,6 +195,35 @@ class Runner:
             self.log("info", result, logger="security")
         return list(devices - restricted_devices)
 
+    def cache_device(self, device):
+        store = vs.run_devices[self.parent_runtime]
+        for property in ("id", "name", "ip_address"):
+            store[property].setdefault(getattr(device, property), device)
+
+    def get_device(self, property, value, **kwargs):
+        device = vs.run_devices[self.parent_runtime][property].get(value)
+        if not device:
+            device = db.fetch("device", allow_none=True, **{property: value}, **kwargs)
+            if device:
+                self.cache_device(device)
+        elif object_session(device) is not db.session():
+            device = db.session.merge(device, load=False)
+        return device
+
+    def get_devices(self, property, values):
+        store, devices = vs.run_devices[self.parent_runtime][property], []
+        missing = {value for value in values if value not in store}
+        for device in db.fetch_in("device", property, missing):
+            self.cache_device(device)
+        for value in values:
+            device = store.get(value)
+            if not device:
+                continue
+            if object_session(device) is not db.session():
+                device = db.session.merge(device, load=False)
+            devices.append(device)
+        return devices
+
     def init_state(self):
         if not env.redis_queue:
             if vs.run_states[self.parent_runtime].get(self.path):
@@ -203,11 +239,7 @@ class Runner:
         if env.redis_queue:
             if isinstance(value, bool):
                 value = str(value)
-            env.redis(
-                {None: "set", "append": "lpush", "increment": "incr"}[method],
-                f"{self.parent_runtime}/state/{self.path}/{path}",
-                value,
-            )
+            env.write_state(self.parent_runtime, f"{self.path}/{path}", value, method)
         else:
             *keys, last = f"{self.parent_runtime}/{self.path}/{path}".split("/")
             store = vs.run_states
@@ -220,6 +252,10 @@ class Runner:
                 store[last] += value
             else:
                 store.setdefault(last, []).append(value)
+            with vs.run_state_lock:
+                versions = vs.run_state_versions[self.parent_runtime]
+                versions["version"] += 1
+                versions["changes"][f"{self.path}/{path}"] = versions["version"]
 
     def start_run(self):
         self.init_state()
@@ -242,9 +278,11 @@ class Runner:
                 error = "\n".join(format_exc().splitlines())
                 self.log("error", error)
                 results.update({"success": False, "error": error})
-            if self.update_pools_after_running:
-                for pool in db.fetch_all("pool", username=self.creator, rbac="edit"):
-                    pool.compute_pool()
+            self.flush_results()
+            incremental_update = vs.settings["pools"]["incremental_update"]
+            if self.update_pools_after_running and not incremental_update:
+                pools = db.fetch_all("pool", username=self.creator, rbac="edit")
+                vs.models["pool"].compute_pools(pools)
             report = self.generate_report(results) if self.service.report else ""
             if self.get("send_notification"):
                 try:
@@ -259,6 +297,8 @@ class Runner:
             now = datetime.now().replace(microsecond=0)
             results["duration"] = str(now - start)
             self.write_state("result/success", results["success"])
+            if env.redis_queue:
+                env.flush_state(self.parent_runtime)
             if self.is_main_run:
                 state = self.main_run.get_state()
                 status = "Aborted" if self.stop else "Completed"
@@ -276,9 +316,24 @@ class Runner:
             must_have_results = not self.has_result and not self.iteration_devices
             if self.is_main_run or len(self.target_devices) > 1 or must_have_results:
                 results = self.create_result(results, run_result=self.is_main_run)
+            if self.is_main_run:
+                self.flush_results()
+                vs.run_results_flush.pop(self.parent_runtime, None)
+                vs.run_devices.pop(self.parent_runtime, None)
+                vs.run_credentials.pop(self.parent_runtime, None)
             if env.redis_queue and self.is_main_run:
-                runtime_keys = env.redis("keys", f"{self.parent_runtime}/*") or []
-                env.redis("delete", *runtime_keys)
+                keys = env.redis("smembers", f"{self.parent_runtime}/keys") or []
+                env.redis(
+                    "unlink",
+                    *(
+                        f"{self.parent_runtime}/{key}"
+                        for key in ("state", "keys", "changes", "version")
+                    ),
+                    *keys,
+                )
+            elif self.is_main_run:
+                vs.run_state_versions.pop(self.parent_runtime, None)
+                env.clear_logs(self.parent_runtime)
             vs.custom.run_post_processing(self, results)
 
         self.results = results
@@ -307,10 +362,85 @@ class Runner:
     @staticmethod
     def get_device_result(args):
         device_id, runtime, results = args
-        device = db.fetch("device", id=device_id)
         run = vs.run_instances[runtime]
+        device = run.get_device("id", device_id)
         results.append(run.get_results(device))
 
+    @staticmethod
+    def open_device_connection(args):
+        device_id, runtime, library = args
+        run = vs.run_instances[runtime]
+        device = run.get_device("id", device_id)
+        try:
+            getattr(run, f"{library}_connection")(device)
+        except Exception as exc:
+            run.log("error", f"Failed to open {library} connection ({exc})", device)
+
+    @staticmethod
+    def init_process():
+        db.engine.dispose(close=False)
+        db.session.registry.clear()
+        env.changelog_pid = None
+
+    @staticmethod
+    def get_process_results(args):
+        device_ids, runtime = args
+        run = vs.run_instances[runtime]
+        run.in_subprocess = True
+        if not env.redis_queue:
+            vs.run_logs[run.parent_runtime] = defaultdict(list)
+            vs.run_log_spills[run.parent_runtime] = {}
+        results = []
+        for device_id in device_ids:
+            if run.stop_event.is_set():
+                vs.run_stop[run.parent_runtime] = True
+            device = run.get_device("id", device_id, rbac=None)
+            device_results = {"runtime": vs.get_time(), **run.get_results(device)}
+            results.append((device_id, run.make_json_compliant(device_results)))
+        db.session.commit()
+        logs = {}
+        if not env.redis_queue:
+            for service_id in list(vs.run_logs[run.parent_runtime]):
+                logs[service_id] = env.log_queue(
+                    run.parent_runtime, service_id, mode="get"
+                )
+            env.clear_logs(run.parent_runtime)
+        return results, logs
+
+    def process_pool_run(self, devices, processes):
+        devices = {device.id: device for device in devices}
+        device_ids, results = list(devices), []
+        chunk_size = max(len(device_ids) // (processes * 10), 1)
+        chunks = [
+            (device_ids[index : index + chunk_size], self.runtime)
+            for index in range(0, len(device_ids), chunk_size)
+        ]
+        self.flush_results()
+        db.session.commit()
+        if env.redis_queue:
+            env.flush_state(self.parent_runtime)
+        context = get_context("fork")
+        self.stop_event = context.Event()
+        with context.Pool(processes, self.init_process) as pool:
+            process_results = pool.imap_unordered(self.get_process_results, chunks)
+            for device_results, logs in process_results:
+                for service_id, service_logs in logs.items():
+                    for log in service_logs:
+                        env.log_queue(self.parent_runtime, service_id, log)
+                for device_id, result in device_results:
+                    self.store_device_results(result, devices[device_id], commit=False)
+                    if not result["success"]:
+                        self.write_state("success", False)
+                    results.append(result)
+                if self.stop:
+                    self.stop_event.set()
+        return results
+
+    def store_device_results(self, results, device, commit=True):
+        status = "success" if results["success"] else "failure"
+        self.write_state(f"{self.progress_key}/{status}", 1, "increment")
+        self.create_result({"runtime": vs.get_time(), **results}, device, commit=commit)
+
     def device_iteration(self, device):
         derived_devices = self.compute_devices_from_query(
             self.service.iteration_devices,
@@ -415,6 +545,7 @@ class Runner:
                 )
                 self.log("error", error)
                 return {"success": False, "runtime": self.runtime, "result": error}
+            self.preopen_connections(non_skipped_targets)
             if (
                 self.get("multiprocessing")
                 and len(non_skipped_targets) > 1
@@ -422,13 +553,23 @@ class Runner:
                 and not self.iteration_run
             ):
                 processes = min(len(non_skipped_targets), self.get("max_processes"))
-                process_args = [
-                    (device.id, self.runtime, results) for device in non_skipped_targets
-                ]
-                self.log("info", f"Starting a pool of {processes} threads")
                 self.in_process = True
-                with ThreadPool(processes=processes) as pool:
-                    pool.map(self.get_device_result, process_args)
+                if self.get("multiprocessing_mode") == "process":
+                    self.log("info", f"Starting a pool of {processes} processes")
+                    process_results = self.process_pool_run(
+                        non_skipped_targets, processes
+                    )
+                    results.extend(process_results)
+                elif hasattr(self.service, "async_job") and not self.iteration_values:
+                    results.extend(self.async_run(non_skipped_targets, processes))
+                else:
+                    process_args = [
+                        (device.id, self.runtime, results)
+                        for device in non_skipped_targets
+                    ]
+                    self.log("info", f"Starting a pool of {processes} threads")
+                    with ThreadPool(processes=processes) as pool:
+                        pool.map(self.get_device_result, process_args)
                 self.in_process = False
             else:
                 results.extend(
@@ -446,9 +587,39 @@ class Runner:
                 "runtime": self.runtime,
             }
 
+    def get_connection_library(self):
+        service_type = self.service.type
+        if service_type == "netconf_service":
+            return "ncclient"
+        elif service_type == "unix_shell_script_service":
+            return "netmiko"
+        for library in ("netmiko", "napalm", "scrapli"):
+            if service_type.startswith(library):
+                return library
+
+    def preopen_connections(self, devices):
+        threads = vs.settings["connection_pool"]["preopen_threads"]
+        library = self.get_connection_library()
+        in_subprocesses = self.get("multiprocessing_mode") == "process"
+        if (
+            not threads
+            or not library
+            or len(devices) < 2
+            or self.in_process
+            or self.start_new_connection
+            or self.get("multiprocessing") and in_subprocesses
+        ):
+            return
+        self.log("info", f"Opening {library} connections to {len(devices)} devices")
+        args = [(device.id, self.runtime, library) for device in devices]
+        with ThreadPool(processes=min(len(devices), threads)) as pool:
+            pool.map(self.open_device_connection, args)
+
     def check_size_before_commit(self, data, data_type):
         column_type = "pickletype" if data_type == "result" else "large_string"
-        data_size = getsizeof(str(data))
+        if not isinstance(data, bytes):
+            data = str(data).encode("utf-8")
+        data_size = len(data)
         max_allowed_size = vs.database["columns"]["length"][column_type]
         if data_size >= max_allowed_size:
             logs = (
@@ -486,15 +657,7 @@ class Runner:
             services = list(vs.run_logs.get(self.parent_runtime, []))
             for service_id in services:
                 logs = env.log_queue(self.parent_runtime, service_id, mode="get")
-                content = "\n".join(logs or [])
-                self.check_size_before_commit(content, "log")
-                db.factory(
-                    "service_log",
-                    runtime=self.parent_runtime,
-                    service=service_id,
-                    content=content,
-                    rbac=None,
-                )
+                self.store_logs(service_id, logs or [])
             if self.main_run.trigger == "REST API":
                 results["devices"] = {}
                 for result in self.main_run.results:
@@ -505,9 +668,22 @@ class Runner:
             results.pop("payload", None)
         create_failed_results = self.disable_result_creation and not self.success
         results = self.make_json_compliant(results)
-        self.check_size_before_commit(results, "result")
+        data = vs.models["result"].serialize(results)
+        prepared_result = vs.models["result"].prepare(results, data)
+        self.check_size_before_commit(prepared_result.get("blob", data), "result")
         if not self.disable_result_creation or create_failed_results or run_result:
             self.has_result = True
+            if device:
+                self.buffer_result(
+                    {
+                        **prepared_result,
+                        **{key: results.get(key) for key in self.result_columns},
+                        **dict.fromkeys(self.optional_result_columns),
+                        **result_kw,
+                    }
+                )
+                return results
+            self.flush_results()
             try:
                 db.factory(
                     "result", result=results, commit=commit, rbac=None, **result_kw
@@ -517,6 +693,123 @@ class Runner:
                 db.session.rollback()
         return results
 
+    def store_logs(self, service_id, lines):
+        chunk_size, chunks = vs.settings["automation"]["log_chunk_size"], []
+        for sequence, start_line in enumerate(range(0, len(lines) or 1, chunk_size)):
+            chunk = lines[start_line : start_line + chunk_size]
+            content = "\n".join(map(dumps, chunk))
+            self.check_size_before_commit(content, "log")
+            log = db.factory(
+                "service_log",
+                runtime=self.parent_runtime,
+                service=service_id,
+                content=content,
+                sequence=sequence,
+                start_line=start_line,
+                line_count=len(chunk),
+                rbac=None,
+            )
+            matches = map(self.device_log_pattern.search, chunk)
+            chunks.append((log, {match.group(1) for match in matches if match}))
+        names = set().union(*(chunk_names for _, chunk_names in chunks))
+        if not names:
+            return
+        devices = {device.name: device.id for device in self.get_devices("name", names)}
+        db.session.flush()
+        values = [
+            {"service_log_id": log.id, "device_id": devices[name]}
+            for log, chunk_names in chunks
+            for name in chunk_names
+            if name in devices
+        ]
+        if values:
+            db.session.execute(db.service_log_device_table.insert(), values)
+
+    def buffer_result(self, row):
+        settings = vs.settings["automation"]["results"]
+        with vs.run_results_lock:
+            buffer = vs.run_results[self.parent_runtime]
+            buffer.append(row)
+            last_flush = vs.run_results_flush.setdefault(self.parent_runtime, time())
+        if (
+            len(buffer) >= settings["buffer_size"]
+            or time() - last_flush >= settings["flush_interval"]
+        ):
+            self.flush_results()
+
+    def flush_results(self):
+        with vs.run_results_lock:
+            rows = vs.run_results.pop(self.parent_runtime, [])
+            vs.run_results_flush[self.parent_runtime] = time()
+        if not rows:
+            return
+        model = vs.models["result"]
+        blobs = {row["blob_id"]: row.pop("blob") for row in rows if row["blob_id"]}
+        for index in range(db.retry_commit_number):
+            try:
+                model.store_blobs(blobs)
+                db.session.execute(model.__table__.insert(), rows)
+                db.session.commit()
+                break
+            except Exception:
+                db.session.rollback()
+                if index == db.retry_commit_number - 1:
+                    error = f"Failed to commit {len(rows)} results:\n{format_exc()}"
+                    self.log("critical", error)
+                else:
+                    sleep(db.retry_commit_time * (index + 1))
+
+    def run_preprocessing(self, device, args, retries, total_retries):
+        if self.number_of_retries - retries:
+            retry = self.number_of_retries - retries
+            self.log("error", f"RETRY n°{retry}", device)
+        if self.service.preprocessing:
+            try:
+                self.eval(self.service.preprocessing, function="exec", **locals())
+            except SystemExit:
+                pass
+
+    def process_job_results(self, results, device, args, retries, total_retries):
+        results = self.convert_result(results)
+        if "success" not in results:
+            results["success"] = True
+        if self.service.postprocessing:
+            if (
+                self.postprocessing_mode == "always"
+                or self.postprocessing_mode == "failure"
+                and not results["success"]
+                or self.postprocessing_mode == "success"
+                and results["success"]
+            ):
+                try:
+                    _, exec_variables = self.eval(
+                        self.service.postprocessing, function="exec", **locals()
+                    )
+                    if isinstance(exec_variables.get("retries"), int):
+                        retries = exec_variables["retries"]
+                except SystemExit:
+                    pass
+            else:
+                log = (
+                    "Postprocessing was skipped as it is set to "
+                    f"{self.postprocessing_mode} only, and the service "
+                    f"{'passed' if results['success'] else 'failed'})"
+                )
+                self.log("warning", log, device)
+        run_validation = (
+            self.validation_condition == "always"
+            or self.validation_condition == "failure"
+            and not results["success"]
+            or self.validation_condition == "success"
+            and results["success"]
+        )
+        if run_validation:
+            section = self.eval(self.validation_section, results=results)[0]
+            results.update(self.validate_result(section, device))
+            if self.negative_logic:
+                results["success"] = not results["success"]
+        return results, retries
+
     def run_service_job(self, device):
         args = (device,) if device else ()
         retries, total_retries = self.number_of_retries + 1, 0
@@ -527,60 +820,16 @@ class Runner:
             retries -= 1
             total_retries += 1
             try:
-                if self.number_of_retries - retries:
-                    retry = self.number_of_retries - retries
-                    self.log("error", f"RETRY n°{retry}", device)
-                if self.service.preprocessing:
-                    try:
-                        self.eval(
-                            self.service.preprocessing, function="exec", **locals()
-                        )
-                    except SystemExit:
-                        pass
+                self.run_preprocessing(device, args, retries, total_retries)
                 try:
                     results = self.service.job(self, *args)
                 except Exception:
                     result = "\n".join(format_exc().splitlines())
                     self.log("error", result, device)
                     results = {"success": False, "result": result}
-                results = self.convert_result(results)
-                if "success" not in results:
-                    results["success"] = True
-                if self.service.postprocessing:
-                    if (
-                        self.postprocessing_mode == "always"
-                        or self.postprocessing_mode == "failure"
-                        and not results["success"]
-                        or self.postprocessing_mode == "success"
-                        and results["success"]
-                    ):
-                        try:
-                            _, exec_variables = self.eval(
-                                self.service.postprocessing, function="exec", **locals()
-                            )
-                            if isinstance(exec_variables.get("retries"), int):
-                                retries = exec_variables["retries"]
-                        except SystemExit:
-                            pass
-                    else:
-                        log = (
-                            "Postprocessing was skipped as it is set to "
-                            f"{self.postprocessing_mode} only, and the service "
-                            f"{'passed' if results['success'] else 'failed'})"
-                        )
-                        self.log("warning", log, device)
-                run_validation = (
-                    self.validation_condition == "always"
-                    or self.validation_condition == "failure"
-                    and not results["success"]
-                    or self.validation_condition == "success"
-                    and results["success"]
+                results, retries = self.process_job_results(
+                    results, device, args, retries, total_retries
                 )
-                if run_validation:
-                    section = self.eval(self.validation_section, results=results)[0]
-                    results.update(self.validate_result(section, device))
-                    if self.negative_logic:
-                        results["success"] = not results["success"]
                 if results["success"]:
                     return results
                 elif retries:
@@ -591,10 +840,91 @@ class Runner:
                 results = {"success": False, "result": result}
         return results
 
-    def get_results(self, device=None, commit=True):
+    async def run_async_service_job(self, device):
+        args = (device,)
+        retries, total_retries = self.number_of_retries + 1, 0
+        while retries and total_retries < self.max_number_of_retries:
+            if self.stop:
+                self.log("error", f"ABORTING {device.name} (STOP)")
+                return {"success": False, "result": "Aborted"}
+            retries -= 1
+            total_retries += 1
+            try:
+                self.run_preprocessing(device, args, retries, total_retries)
+                try:
+                    results = await self.service.async_job(self, device)
+                except Exception:
+                    result = "\n".join(format_exc().splitlines())
+                    self.log("error", result, device)
+                    results = {"success": False, "result": result}
+                results, retries = self.process_job_results(
+                    results, device, args, retries, total_retries
+                )
+                if results["success"]:
+                    return results
+                elif retries:
+                    await async_sleep(self.time_between_retries)
+            except Exception:
+                result = "\n".join(format_exc().splitlines())
+                self.log("error", result, device)
+                results = {"success": False, "result": result}
+        return results
+
+    async def get_async_results(self, device, semaphore):
+        async with semaphore:
+            start, results = self.start_device_job(device)
+            if self.stop:
+                return {"success": False, **results}
+            try:
+                results.update(await self.run_async_service_job(device))
+            except Exception:
+                self.log_job_error(results, device)
+            status = "success" if results["success"] else "failure"
+            self.write_state(f"{self.progress_key}/{status}", 1, "increment")
+            waiting_time = self.end_device_job(results, device, start)
+            if waiting_time:
+                await async_sleep(waiting_time)
+            return results
+
+    async def async_device_run(self, devices, tasks):
+        semaphore = Semaphore(tasks)
+        return await gather(
+            *(self.get_async_results(device, semaphore) for device in devices)
+        )
+
+    def async_run(self, devices, processes):
+        tasks = min(processes, vs.settings["automation"]["max_async_tasks"])
+        self.log("info", f"Starting an asynchronous run of {tasks} tasks")
+        results = asyncio_run(self.async_device_run(devices, tasks))
+        for device, device_results in zip(devices, results):
+            self.create_result(
+                {"runtime": vs.get_time(), **device_results}, device, commit=False
+            )
+            if not device_results["success"]:
+                self.write_state("success", False)
+        return results
+
+    def start_device_job(self, device):
         self.log("info", "STARTING", device)
         start = datetime.now().replace(microsecond=0)
-        results = {"device_target": getattr(device, "name", None)}
+        return start, {"device_target": getattr(device, "name", None)}
+
+    def log_job_error(self, results, device):
+        formatted_error = "\n".join(format_exc().splitlines())
+        results.update({"success": False, "result": formatted_error})
+        self.log("error", formatted_error, device)
+
+    def end_device_job(self, results, device, start):
+        results["duration"] = str(datetime.now().replace(microsecond=0) - start)
+        if device and (getattr(self, "close_connection", False) or self.is_main_run):
+            self.close_device_connection(device.name)
+        self.log("info", "FINISHED", device)
+        if self.waiting_time:
+            self.log("info", f"SLEEP {self.waiting_time} seconds...", device)
+        return self.waiting_time
+
+    def get_results(self, device=None, commit=True):
+        start, results = self.start_device_job(device)
         if self.stop:
             return {"success": False, **results}
         try:
@@ -623,23 +953,13 @@ class Runner:
             else:
                 results.update(self.run_service_job(device))
         except Exception:
-            formatted_error = "\n".join(format_exc().splitlines())
-            results.update({"success": False, "result": formatted_error})
-            self.log("error", formatted_error, device)
-        results["duration"] = str(datetime.now().replace(microsecond=0) - start)
-        if device:
-            if getattr(self, "close_connection", False) or self.is_main_run:
-                self.close_device_connection(device.name)
-            status = "success" if results["success"] else "failure"
-            self.write_state(f"{self.progress_key}/{status}", 1, "increment")
-            self.create_result(
-                {"runtime": vs.get_time(), **results}, device, commit=commit
-            )
-        self.log("info", "FINISHED", device)
-        if self.waiting_time:
-            self.log("info", f"SLEEP {self.waiting_time} seconds...", device)
-            sleep(self.waiting_time)
-        if not results["success"]:
+            self.log_job_error(results, device)
+        waiting_time = self.end_device_job(results, device, start)
+        if device and not self.in_subprocess:
+            self.store_device_results(results, device, commit=commit)
+        if waiting_time:
+            sleep(waiting_time)
+        if not results["success"] and not self.in_subprocess:
             self.write_state("success", False)
         return results
 
@@ -776,29 +1096,73 @@ class Runner:
         results["notification"] = {"success": True, "result": result}
         return results
 
+    def get_credential_data(self, credential):
+        if not credential:
+            return
+        cache = vs.run_credentials[self.parent_runtime]
+        key = ("credential", credential.id)
+        if key not in cache:
+            properties = ("id", "name", "username", "subtype", "enable_password")
+            cache[key] = {
+                property: getattr(credential, property) for property in properties
+            }
+            secret = "password" if credential.subtype == "password" else "private_key"
+            cache[key][secret] = getattr(credential, secret)
+        return cache[key]
+
+    def get_device_credential(self, device, credential_type):
+        optional = self.credentials != "device"
+        if not device:
+            credential = db.get_credential(
+                self.creator, credential_type=credential_type, optional=optional
+            )
+            return self.get_credential_data(credential)
+        cache = vs.run_credentials[self.parent_runtime]
+        if ("device", credential_type, device.name) not in cache:
+            names = {device.name} | set(vs.run_devices[self.parent_runtime]["name"])
+            missing_names = [
+                name for name in names if ("device", credential_type, name) not in cache
+            ]
+            credentials = db.get_device_credentials(
+                self.creator, missing_names, credential_type
+            )
+            if env.use_vault:
+                env.prefetch_secrets(set(filter(None, credentials.values())))
+            for name, credential in credentials.items():
+                credential_data = self.get_credential_data(credential)
+                cache[("device", credential_type, name)] = credential_data
+        credential = cache[("device", credential_type, device.name)]
+        if not credential and not optional:
+            raise Exception(f"No matching credentials found for DEVICE '{device.name}'")
+        return credential
+
+    def get_secret(self, credential, property):
+        cache = vs.run_credentials[self.parent_runtime]
+        key = ("secret", credential["id"], property)
+        if key not in cache:
+            value = env.get_password(credential[property])
+            if property == "private_key":
+                value = RSAKey.from_private_key(StringIO(value))
+            cache[key] = value
+        return cache[key]
+
     def get_credentials(self, device, add_secret=True):
         result, credential_type = {}, self.main_run.service.credential_type
         if self.credentials == "object":
-            credential = self.named_credential
+            credential = self.get_credential_data(self.named_credential)
         else:
-            credential = db.get_credential(
-                self.creator,
-                device=device,
-                credential_type=credential_type,
-                optional=self.credentials != "device",
-            )
+            credential = self.get_device_credential(device, credential_type)
         if credential:
             device_log = f" for '{device.name}'" if device else ""
-            self.log("info", f"Using '{credential.name}' credential{device_log}")
+            self.log("info", f"Using '{credential['name']}' credential{device_log}")
         if add_secret and device and credential:
-            result["secret"] = env.get_password(credential.enable_password)
+            result["secret"] = self.get_secret(credential, "enable_password")
         if self.credentials in ("device", "object"):
-            result["username"] = credential.username
-            if credential.subtype == "password":
-                result["password"] = env.get_password(credential.password)
+            result["username"] = credential["username"]
+            if credential["subtype"] == "password":
+                result["password"] = self.get_secret(credential, "password")
             else:
-                private_key = env.get_password(credential.private_key)
-                result["pkey"] = RSAKey.from_private_key(StringIO(private_key))
+                result["pkey"] = self.get_secret(credential, "private_key")
         else:
             result["username"] = self.sub(self.custom_username, locals())
             password = env.get_password(self.custom_password)
@@ -917,6 +1281,7 @@ class Runner:
         return self.payload_helper(*args, operation="get", **kwargs)
 
     def get_result(self, service_name, device=None, workflow=None, all_matches=False):
+        self.flush_results()
         def filter_run(query, property):
             query = query.filter(
                 vs.models["result"].service.has(
@@ -953,6 +1318,7 @@ class Runner:
         return recursive_search(self.main_run)
 
     def get_all_results(self):
+        self.flush_results()
         return db.fetch_all("result", parent_runtime=self.parent_runtime)
 
     @staticmethod
@@ -1084,6 +1450,11 @@ class Runner:
             self.log("info", f"Using cached {connection_name}", device)
             return self.update_netmiko_connection(connection)
         driver = device.netmiko_driver if self.driver == "device" else self.driver
+        credentials = self.get_credentials(device)
+        pool_key = self.get_pool_key("netmiko", device, driver, credentials)
+        connection = self.acquire_connection(pool_key, device)
+        if connection:
+            return self.update_netmiko_connection(connection)
         self.log(
             "info",
             f"OPENING {connection_name} (driver: {driver})",
@@ -1091,51 +1462,60 @@ class Runner:
             change_log=False,
             logger="security",
         )
-        sock = None
+        sock = gateway_key = None
+        slots = []
         if device.gateways:
             gateways = sorted(device.gateways, key=attrgetter("priority"), reverse=True)
             for gateway in gateways:
                 try:
-                    credentials = self.get_credentials(gateway, add_secret=False)
                     connection_log = f"Trying to establish connection to {gateway}"
                     self.log("info", connection_log, device, logger="security")
-                    client = SSHClient()
-                    client.set_missing_host_key_policy(AutoAddPolicy())
-                    client.connect(
-                        hostname=gateway.ip_address, port=gateway.port, **credentials
-                    )
-                    sock = client.get_transport().open_channel(
-                        "direct-tcpip", (device.ip_address, device.port), ("", 0)
-                    )
+                    with self.connection_slot("gateway", gateway.name) as slot:
+                        key, transport = self.get_gateway_transport(gateway, device)
+                        sock = transport.open_channel(
+                            "direct-tcpip", (device.ip_address, device.port), ("", 0)
+                        )
+                    gateway_key = key
+                    slots.append(slot)
                     break
                 except Exception:
                     error_log = f"Connection to {gateway} failed:\n{format_exc()}"
                     self.log("error", error_log, device)
-        netmiko_connection = ConnectHandler(
-            device_type=driver,
-            ip=device.ip_address,
-            port=device.port,
-            timeout=self.conn_timeout,
-            conn_timeout=self.conn_timeout,
-            auth_timeout=self.auth_timeout or None,
-            banner_timeout=self.banner_timeout,
-            fast_cli=self.fast_cli,
-            global_delay_factor=self.global_delay_factor,
-            session_log=BytesIO(),
-            sock=sock,
-            **self.get_credentials(device),
-        )
-        if self.enable_mode:
-            netmiko_connection.enable()
-        if self.config_mode:
-            kwargs = {}
-            if getattr(self, "config_mode_command", None):
-                kwargs["config_command"] = self.config_mode_command
-            netmiko_connection.config_mode(**kwargs)
+        try:
+            with self.connection_slot("device", device.name) as slot:
+                netmiko_connection = ConnectHandler(
+                    device_type=driver,
+                    ip=device.ip_address,
+                    port=device.port,
+                    timeout=self.conn_timeout,
+                    conn_timeout=self.conn_timeout,
+                    auth_timeout=self.auth_timeout or None,
+                    banner_timeout=self.banner_timeout,
+                    fast_cli=self.fast_cli,
+                    global_delay_factor=self.global_delay_factor,
+                    session_log=BytesIO(),
+                    sock=sock,
+                    **credentials,
+                )
+        except Exception:
+            self.release_slots(slots)
+            raise
+        vs.connection_slots[id(netmiko_connection)] = [*slots, slot]
+        try:
+            if self.enable_mode:
+                netmiko_connection.enable()
+            if self.config_mode:
+                kwargs = {}
+                if getattr(self, "config_mode_command", None):
+                    kwargs["config_command"] = self.config_mode_command
+                netmiko_connection.config_mode(**kwargs)
+        except Exception:
+            self.terminate_connection("netmiko", netmiko_connection)
+            raise
         netmiko_connection.password = "*" * 8
-        vs.connections_cache["netmiko"][self.parent_runtime].setdefault(
-            device.name, {}
-        )[self.connection_name] = netmiko_connection
+        if sock:
+            vs.gateway_users[id(netmiko_connection)] = gateway_key
+        self.cache_connection(device, netmiko_connection, pool_key)
         return netmiko_connection
 
     def scrapli_connection(self, device):
@@ -1144,6 +1524,15 @@ class Runner:
         if connection:
             self.log("info", f"Using cached {connection_name}", device)
             return connection
+        credentials = self.get_credentials(device)
+        is_netconf = self.service.type == "scrapli_netconf_service"
+        connection_class, kwargs = NetconfDriver if is_netconf else Scrapli, {}
+        platform = device.scrapli_driver if self.driver == "device" else self.driver
+        driver = "netconf" if is_netconf else platform
+        pool_key = self.get_pool_key("scrapli", device, driver, credentials)
+        connection = self.acquire_connection(pool_key, device)
+        if connection:
+            return connection
         self.log(
             "info",
             f"OPENING {connection_name}",
@@ -1151,13 +1540,9 @@ class Runner:
             change_log=False,
             logger="security",
         )
-        credentials = self.get_credentials(device)
-        is_netconf = self.service.type == "scrapli_netconf_service"
-        connection_class, kwargs = NetconfDriver if is_netconf else Scrapli, {}
         if is_netconf:
             kwargs["strip_namespaces"] = self.strip_namespaces
         else:
-            platform = device.scrapli_driver if self.driver == "device" else self.driver
             kwargs.update(
                 {
                     "transport": self.transport,
@@ -1174,10 +1559,10 @@ class Runner:
             **vs.automation["scrapli"]["connection_args"],
             **kwargs,
         )
-        connection.open()
-        vs.connections_cache["scrapli"][self.parent_runtime].setdefault(
-            device.name, {}
-        )[self.connection_name] = connection
+        with self.connection_slot("device", device.name) as slot:
+            connection.open()
+        vs.connection_slots[id(connection)] = [slot]
+        self.cache_connection(device, connection, pool_key)
         return connection
 
     def napalm_connection(self, device):
@@ -1186,6 +1571,12 @@ class Runner:
         if connection:
             self.log("info", f"Using cached {connection_name}", device)
             return connection
+        credentials = self.get_credentials(device)
+        driver = device.napalm_driver if self.driver == "device" else self.driver
+        pool_key = self.get_pool_key("napalm", device, driver, credentials)
+        connection = self.acquire_connection(pool_key, device)
+        if connection:
+            return connection
         self.log(
             "info",
             f"OPENING {connection_name}",
@@ -1193,25 +1584,21 @@ class Runner:
             change_log=False,
             logger="security",
         )
-        credentials = self.get_credentials(device)
         optional_args = self.service.optional_args
         if not optional_args:
             optional_args = {}
         if "secret" not in optional_args:
             optional_args["secret"] = credentials.pop("secret", None)
-        driver = get_network_driver(
-            device.napalm_driver if self.driver == "device" else self.driver
-        )
-        napalm_connection = driver(
+        napalm_connection = get_network_driver(driver)(
             hostname=device.ip_address,
             timeout=self.timeout,
             optional_args=optional_args,
             **credentials,
         )
-        napalm_connection.open()
-        vs.connections_cache["napalm"][self.parent_runtime].setdefault(device.name, {})[
-            self.connection_name
-        ] = napalm_connection
+        with self.connection_slot("device", device.name) as slot:
+            napalm_connection.open()
+        vs.connection_slots[id(napalm_connection)] = [slot]
+        self.cache_connection(device, napalm_connection, pool_key)
         return napalm_connection
 
     def ncclient_connection(self, device):
@@ -1220,6 +1607,12 @@ class Runner:
         if connection:
             self.log("info", f"Using cached {connection_name}", device)
             return connection
+        credentials = self.get_credentials(device)
+        driver = device.netconf_driver or "default"
+        pool_key = self.get_pool_key("ncclient", device, driver, credentials)
+        connection = self.acquire_connection(pool_key, device)
+        if connection:
+            return connection
         self.log(
             "info",
             f"OPENING {connection_name}",
@@ -1227,19 +1620,18 @@ class Runner:
             change_log=False,
             logger="security",
         )
-        credentials = self.get_credentials(device)
-        ncclient_connection = manager.connect(
-            host=device.ip_address,
-            port=830,
-            hostkey_verify=False,
-            look_for_keys=False,
-            device_params={"name": device.netconf_driver or "default"},
-            username=credentials["username"],
-            password=credentials["password"],
-        )
-        vs.connections_cache["ncclient"][self.parent_runtime].setdefault(
-            device.name, {}
-        )[self.connection_name] = ncclient_connection
+        with self.connection_slot("device", device.name) as slot:
+            ncclient_connection = manager.connect(
+                host=device.ip_address,
+                port=830,
+                hostkey_verify=False,
+                look_for_keys=False,
+                device_params={"name": driver},
+                username=credentials["username"],
+                password=credentials["password"],
+            )
+        vs.connection_slots[id(ncclient_connection)] = [slot]
+        self.cache_connection(device, ncclient_connection, pool_key)
         return ncclient_connection
 
     def get_or_close_connection(self, library, device):
@@ -1248,25 +1640,196 @@ class Runner:
             return
         if self.start_new_connection:
             return self.disconnect(library, device, connection)
-        if library == "napalm":
-            if connection.is_alive():
-                return connection
+        if self.is_alive(library, connection):
+            return connection
+        vs.connection_leases.pop(id(connection), None)
+        self.disconnect(library, device, connection)
+
+    @staticmethod
+    def is_alive(library, connection):
+        try:
+            if library == "napalm":
+                return bool(connection.is_alive())
+            elif library == "ncclient":
+                return connection.connected
+            elif library == "netmiko":
+                connection.find_prompt()
             else:
-                self.disconnect(library, device, connection)
-        elif library == "ncclient":
-            if connection.connected:
-                return connection
+                connection.get_prompt()
+            return True
+        except Exception:
+            return False
+
+    @contextmanager
+    def connection_slot(self, kind, name):
+        settings = vs.settings["connection_pool"]
+        limit, slot = settings[f"{kind}_concurrency"], (kind, name)
+        if not limit:
+            yield
+            return
+        with vs.connection_pool_lock:
+            semaphore_users = vs.connection_semaphores.setdefault(
+                slot, [BoundedSemaphore(limit), 0]
+            )
+            semaphore_users[1] += 1
+        semaphore = semaphore_users[0]
+        if not semaphore.acquire(timeout=1):
+            slots = vs.connection_slots
+            self.remove_pooled_connections(
+                lambda connection, _: slot in slots.get(id(connection), ())
+            )
+            if not semaphore.acquire(timeout=settings["concurrency_timeout"]):
+                self.release_slots([slot], acquired=False)
+                raise Exception(f"Too many open connections to {kind} {name}")
+        try:
+            yield slot
+        except Exception:
+            self.release_slots([slot])
+            raise
+
+    @staticmethod
+    def release_slots(slots, acquired=True):
+        with vs.connection_pool_lock:
+            for slot in filter(None, slots):
+                semaphore, users = vs.connection_semaphores[slot]
+                if acquired:
+                    semaphore.release()
+                if users == 1:
+                    vs.connection_semaphores.pop(slot)
+                else:
+                    vs.connection_semaphores[slot][1] -= 1
+
+    def get_gateway_transport(self, gateway, device):
+        settings = vs.settings["connection_pool"]
+        credentials = self.get_credentials(gateway, add_secret=False)
+        key = (
+            None if settings["active"] else self.parent_runtime,
+            gateway.name,
+            *self.get_credentials_key(credentials),
+        )
+        with vs.connection_pool_lock:
+            lock = vs.gateway_locks.setdefault(key, Lock())
+        with lock:
+            client, _ = vs.gateway_transports.get(key, (None, None))
+            transport = client.get_transport() if client else None
+            if transport and transport.is_active():
+                self.log("info", f"Using cached transport to {gateway}", device)
             else:
-                self.disconnect(library, device, connection)
-        else:
+                if client:
+                    client.close()
+                client = SSHClient()
+                client.set_missing_host_key_policy(AutoAddPolicy())
+                try:
+                    client.connect(
+                        hostname=gateway.ip_address, port=gateway.port, **credentials
+                    )
+                except Exception:
+                    vs.gateway_transports.pop(key, None)
+                    client.close()
+                    raise
+                transport = client.get_transport()
+                transport.set_keepalive(settings["gateway_keepalive"])
+            vs.gateway_transports[key] = (client, time())
+        return key, transport
+
+    @staticmethod
+    def close_gateway_transports(runtime, idle_timeout=None):
+        with vs.connection_pool_lock:
+            used_transports = set(vs.gateway_users.values())
+            keys = [
+                key
+                for key, (_, last_used) in vs.gateway_transports.items()
+                if key[0] == runtime
+                and (
+                    idle_timeout is None
+                    or key not in used_transports
+                    and time() - last_used >= idle_timeout
+                )
+            ]
+            for key in keys:
+                vs.gateway_locks.pop(key, None)
+            clients = [vs.gateway_transports.pop(key)[0] for key in keys]
+        for client in clients:
             try:
-                if library == "netmiko":
-                    connection.find_prompt()
-                else:
-                    connection.get_prompt()
-                return connection
+                client.close()
             except Exception:
-                self.disconnect(library, device, connection)
+                pass
+
+    @staticmethod
+    def get_credentials_key(credentials):
+        pkey = credentials.get("pkey")
+        return (
+            credentials.get("username"),
+            hash(credentials.get("password")),
+            pkey.get_fingerprint() if pkey else None,
+        )
+
+    def get_pool_key(self, library, device, driver, credentials):
+        return (library, device.name, driver, *self.get_credentials_key(credentials))
+
+    def acquire_connection(self, pool_key, device):
+        settings = vs.settings["connection_pool"]
+        if not settings["active"] or self.start_new_connection:
+            return
+        library = pool_key[0]
+        while True:
+            with vs.connection_pool_lock:
+                if not vs.connection_pool.get(pool_key):
+                    return
+                connection, last_used = vs.connection_pool[pool_key].pop()
+            if time() - last_used < settings["idle_timeout"]:
+                if self.is_alive(library, connection):
+                    break
+            self.terminate_connection(library, connection)
+        self.log("info", f"Using pooled {library} connection", device)
+        self.cache_connection(device, connection, pool_key)
+        return connection
+
+    def release_connection(self, connection):
+        settings = vs.settings["connection_pool"]
+        pool_key = vs.connection_leases.pop(id(connection), None)
+        if not pool_key or not settings["active"]:
+            return False
+        with vs.connection_pool_lock:
+            pool = vs.connection_pool[pool_key]
+            if len(pool) >= settings["max_connections_per_device"]:
+                return False
+            pool.append((connection, time()))
+        return True
+
+    @classmethod
+    def expire_pooled_connections(cls):
+        idle_timeout = vs.settings["connection_pool"]["idle_timeout"]
+        cls.remove_pooled_connections(
+            lambda _, last_used: time() - last_used >= idle_timeout
+        )
+        cls.close_gateway_transports(None, idle_timeout)
+
+    @classmethod
+    def remove_pooled_connections(cls, condition):
+        removed_connections = []
+        with vs.connection_pool_lock:
+            for pool_key, pool in list(vs.connection_pool.items()):
+                for connection, last_used in list(pool):
+                    if not condition(connection, last_used):
+                        continue
+                    pool.remove((connection, last_used))
+                    removed_connections.append((pool_key[0], connection))
+                if not pool:
+                    vs.connection_pool.pop(pool_key)
+        for library, connection in removed_connections:
+            try:
+                cls.terminate_connection(library, connection)
+            except Exception:
+                pass
+
+    def cache_connection(self, device, connection, pool_key):
+        library = pool_key[0]
+        vs.connections_cache[library][self.parent_runtime].setdefault(
+            device.name, {}
+        )[self.connection_name] = connection
+        if vs.settings["connection_pool"]["active"]:
+            vs.connection_leases[id(connection)] = pool_key
 
     def get_connection(self, library, device, name=None):
         cache = vs.connections_cache[library].get(self.parent_runtime, {})
@@ -1285,6 +1848,8 @@ class Runner:
             device_connections = vs.connections_cache[library][self.parent_runtime]
             for device, connections in list(device_connections.items()):
                 for connection in list(connections.values()):
+                    if self.release_connection(connection):
+                        continue
                     args = (library, device, connection)
                     thread = Thread(target=self.disconnect, args=args)
                     thread.start()
@@ -1293,24 +1858,42 @@ class Runner:
             thread.join()
         for library in ("netmiko", "napalm", "scrapli", "ncclient"):
             vs.connections_cache[library].pop(self.parent_runtime)
+        self.close_gateway_transports(self.parent_runtime)
+        if vs.settings["connection_pool"]["active"]:
+            self.expire_pooled_connections()
 
     def disconnect(self, library, device, connection):
         connection_name = getattr(self, "connection_name", "default")
         connection_log = f"{library} connection '{connection_name}'"
         try:
-            if library == "netmiko":
-                connection.disconnect()
-            elif library == "ncclient":
-                connection.close_session()
+            release = not self.start_new_connection and not getattr(
+                self, "close_connection", False
+            )
+            if release and self.release_connection(connection):
+                self.log("info", f"Released {connection_log} to the pool", device)
             else:
-                connection.close()
+                vs.connection_leases.pop(id(connection), None)
+                self.terminate_connection(library, connection)
+                self.log("info", f"Closed {connection_log}", device)
             vs.connections_cache[library][self.parent_runtime][device].pop(
                 connection_name
             )
-            self.log("info", f"Closed {connection_log}", device)
         except Exception as exc:
             self.log("error", f"Error while closing {connection_log} ({exc})", device)
 
+    @classmethod
+    def terminate_connection(cls, library, connection):
+        vs.gateway_users.pop(id(connection), None)
+        try:
+            if library == "netmiko":
+                connection.disconnect()
+            elif library == "ncclient":
+                connection.close_session()
+            else:
+                connection.close()
+        finally:
+            cls.release_slots(vs.connection_slots.pop(id(connection), []))
+
     def enter_remote_device(self, connection, device):
         if not getattr(self, "jump_on_connect", False):
             return
@@ -584,11 +584,11 @@ function refreshLogs(service, runtime, editor, first, wasRefreshed, line) {
     url: `/get_service_logs/${service.id}/${runtime}`,
     data: { line: line || 0, device: $("#device-filter").val() },
     callback: function(result) {
-      if (!first && result.refresh && result.logs.length) {
+      if (!first && result.logs.length) {
         // eslint-disable-next-line new-cap
         editor.replaceRange(`\n${result.logs}`, CodeMirror.Pos(editor.lineCount()));
         editor.setCursor(editor.lineCount(), 0);
-      } else if (first || !result.refresh) {
+      } else if (first) {
         editor.setValue(`Gathering logs for '${service.name}'...\n\n${result.logs}`);
         editor.refresh();
       }
@@ -148,7 +148,7 @@ export function observeMutations(container, target, callback) {
   }).observe(container, { childList: true, subtree: true });
 }
 
-export const call = function({ url, data, form, callback }) {
+export const call = function({ url, data, form, callback, errorCallback }) {
   let params = {
     type: "POST",
     url: url,
@@ -156,6 +156,7 @@ export const call = function({ url, data, form, callback }) {
       processResults(callback, results);
     },
     error: function(error) {
+      if (errorCallback) return errorCallback(error);
       let message = `Error HTTP ${error.status}: ${error.statusText}.`;
       if (error.status == 400) {
         message += " Your session might have expired, try refreshing the page.";
@@ -188,9 +188,10 @@ function updatePools(pool) {
   const endpoint = pool ? `/update_pool/${pool}` : "/update_all_pools";
   call({
     url: endpoint,
-    callback: function() {
+    callback: function(result) {
       tableInstances.pool.table.ajax.reload(null, false);
-      notify("Pool Update successful.", "success", 5, true);
+      const duration = result ? ` (${result.duration}s)` : "";
+      notify(`Pool Update successful${duration}.`, "success", 5, true);
     },
   });
 }
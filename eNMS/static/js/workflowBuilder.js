@@ -71,6 +71,10 @@ export let currentRuntime = linkRuntime;
 export let graph;
 
 let currentRun;
+let currentRuntimes;
+let currentState;
+let stateVersion;
+let stateDeltaUnavailable;
 let currentPlaceholder;
 let placeholder;
 let isSuperworkflow;
@@ -600,6 +604,9 @@ export function getServiceState(id, first) {
 
 function displayWorkflowState(result) {
   if ($("#workflow-search").val()) return;
+  currentRuntimes = result.runtimes;
+  currentState = result.state;
+  stateVersion = result.version;
   resetWorkflowDisplay();
   updateRuntimes(result);
   if (currentRuntime == "normal") return;
@@ -702,9 +709,57 @@ export function resetWorkflowDisplay() {
   }
 }
 
+function mergeState(state, delta) {
+  for (const [key, value] of Object.entries(delta)) {
+    if (value && typeof value == "object" && !Array.isArray(value)) {
+      if (typeof state[key] != "object" || state[key] === null) state[key] = {};
+      mergeState(state[key], value);
+    } else {
+      state[key] = value;
+    }
+  }
+  return state;
+}
+
+function getWorkflowStateDelta() {
+  call({
+    url: `/get_service_state_delta/${currentPath}`,
+    data: { runtime: currentRun.runtime, version: stateVersion },
+    callback: function(result) {
+      if (
+        !result.delta ||
+        result.run.status != "Running" ||
+        result.last_modified > instance.last_modified
+      ) {
+        stateVersion = null;
+        return getWorkflowState(false, false);
+      }
+      currentRun = result.run;
+      displayWorkflowState({
+        runtimes: currentRuntimes,
+        state: mergeState(currentState || {}, result.state),
+        version: result.version,
+      });
+    },
+    errorCallback: function() {
+      stateDeltaUnavailable = true;
+      stateVersion = null;
+      getWorkflowState(false, false);
+    },
+  });
+}
+
 export function getWorkflowState(periodic, first) {
   const runtime = $("#current-runtime").val();
-  if (userIsActive && workflow?.id && !first) {
+  const deltaAllowed =
+    currentRun?.status == "Running" &&
+    stateVersion != null &&
+    !stateDeltaUnavailable &&
+    [currentRun.runtime, "latest"].includes(runtime) &&
+    !$("#device-filter").val();
+  if (userIsActive && workflow?.id && !first && deltaAllowed) {
+    getWorkflowStateDelta();
+  } else if (userIsActive && workflow?.id && !first) {
     call({
       url: `/get_service_state/${currentPath}`,
       data: {
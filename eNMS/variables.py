@@ -10,6 +10,7 @@ from os import getenv
 from pathlib import Path
 from string import punctuation
 from sys import modules
+from threading import Lock
 from traceback import format_exc
 from warnings import warn
 from wtforms.validators import __all__ as all_validators
@@ -159,11 +160,31 @@ class VariableStore:
         self.run_services = defaultdict(set)
         self.run_states = defaultdict(dict)
         self.run_logs = defaultdict(lambda: defaultdict(list))
+        self.run_log_spills = defaultdict(dict)
+        self.run_logs_lock = Lock()
         self.run_stop = defaultdict(bool)
         self.run_instances = {}
+        self.run_devices = defaultdict(lambda: defaultdict(dict))
+        self.run_credentials = defaultdict(dict)
+        self.run_results = defaultdict(list)
+        self.run_results_flush = {}
+        self.run_results_lock = Lock()
+        self.run_state_versions = defaultdict(lambda: {"version": 0, "changes": {}})
+        self.run_state_lock = Lock()
         libraries = ("netmiko", "napalm", "scrapli", "ncclient")
         self.connections_cache = {library: defaultdict(dict) for library in libraries}
+        self.connection_pool = defaultdict(list)
+        self.connection_leases = {}
+        self.connection_pool_lock = Lock()
+        self.connection_semaphores = {}
+        self.connection_slots = {}
+        self.gateway_locks = {}
+        self.gateway_transports = {}
+        self.gateway_users = {}
         self.service_run_count = defaultdict(int)
+        self.workflow_graphs = {}
+        self.rbac_targets = {}
+        self.rbac_versions = defaultdict(int)
 
     def set_template_context(self):
         self.template_context = {